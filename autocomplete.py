@@ -1,19 +1,33 @@
 # -*- coding: UTF-8 -*-
 
+import bisect
+import heapq
+from collections import OrderedDict
+from itertools import chain
+from operator import itemgetter
+import os
 import re
 import sublime
 import sublime_plugin
+import sys
+import threading
 import time
 
 if int(sublime.version()) < 3000:
     from sublime_haskell_common import *
     from hdevtools import start_hdevtools, stop_hdevtools
     import hsdev
+    import snapshot
+    import symbol_index
+    import symbols
     from worker import run_async
 else:
     from SublimeHaskell.sublime_haskell_common import *
     from SublimeHaskell.hdevtools import start_hdevtools, stop_hdevtools
     import SublimeHaskell.hsdev as hsdev
+    import SublimeHaskell.snapshot as snapshot
+    import SublimeHaskell.symbol_index as symbol_index
+    import SublimeHaskell.symbols as symbols
     from SublimeHaskell.worker import run_async
 
 
@@ -73,46 +87,509 @@ def get_flags_pragmas():
     return []
 
 
+# Completions are kept sorted by lowercased inserted text
+# Sorted lists are stored "keyed", as (key, completion) pairs, so that they can be merged and indexed without computing keys again
+def completion_key(c):
+    return symbols.intern_string(c[1].lower())
+
+
+def unique_keyed(keyed):
+    """ Drop duplicates from sorted keyed completions, duplicates have same key """
+    result = []
+    last_key = None
+    same_key = []
+    for (k, c) in keyed:
+        if k != last_key:
+            last_key = k
+            same_key = [c]
+        elif c in same_key:
+            continue
+        else:
+            same_key.append(c)
+        result.append((k, c))
+    return result
+
+
+def keyed_completions(comps):
+    """ Sorted unique keyed completions """
+    return unique_keyed(sorted(((completion_key(c), c) for c in comps), key = itemgetter(0)))
+
+
+def declarations_completions(decls):
+    """ Sorted unique keyed completions for declarations """
+    return unique_keyed(sorted((d.completion() for d in (decls or []) if d), key = itemgetter(0)))
+
+
+def module_stamp(m):
+    """
+    Stamp of module's contents: modification time of source file, None if it can't be read
+    Installed modules don't change without changing location (package version), so their stamp is constant
+    """
+    if not m.by_source():
+        return 0
+    try:
+        return os.path.getmtime(m.location.filename)
+    except (IOError, OSError):
+        return None
+
+
+def merge_completions(*keyed_lists):
+    """
+    Merge sorted keyed completions lists
+    Sort of concatenated sorted lists only merges runs, which is faster than heapq.merge in Python
+    """
+    return unique_keyed(sorted(chain(*keyed_lists), key = itemgetter(0)))
+
+
+def unkeyed(keyed):
+    return [c for (_, c) in keyed]
+
+
 def sort_completions(comps):
-    comps.sort(key = lambda k: k[0])
+    comps.sort(key = completion_key)
 
 
 def sorted_completions(comps):
-    return list(set(comps))  # unique + sort
+    return unkeyed(keyed_completions(comps))
 
 
 def make_completions(suggestions):
-    return sorted_completions([s.suggest() for s in (suggestions or [])])
+    return unkeyed(declarations_completions(suggestions))
+
+
+def completion_size(c):
+    return sys.getsizeof(c) + sys.getsizeof(c[0]) + sys.getsizeof(c[1])
+
+
+def completions_size(comps):
+    """ Approximate memory, used by completions list, in bytes """
+    return sys.getsizeof(comps) + sum(completion_size(c) for c in comps)
 
 
 def make_locations(comps):
     return sorted([[s.brief(), s.get_source_location()] for s in comps if s.has_source_location()], key = lambda k: k[0])
 
 
+class CompletionIndex(object):
+    """
+    Completions sorted by lowercased inserted text, so that completions for prefix are found with bisect
+    """
+    def __init__(self, keyed):
+        """ keyed — sorted keyed completions """
+        self.comps = unkeyed(keyed)
+        self.keys = [k for (k, _) in keyed]
+
+    def __len__(self):
+        return len(self.comps)
+
+    def size(self):
+        """ Size of index itself, completions and keys are shared """
+        return sys.getsizeof(self) + sys.getsizeof(self.comps) + sys.getsizeof(self.keys)
+
+    def prefixed(self, prefix, limit = None, rank = None):
+        """
+        Completions, which inserted text starts with prefix (case-insensitive)
+        Best first by rank key function, by default: case-sensitive matches, then shorter names
+        At most limit results if limit is set
+        """
+        key = prefix.lower()
+        i = bisect.bisect_left(self.keys, key)
+        # Keys with prefix are less than prefix with last char incremented
+        j = bisect.bisect_left(self.keys, key[:-1] + chr(ord(key[-1]) + 1), i) if key else len(self.keys)
+        matches = self.comps[i:j]
+
+        if rank is None:
+            def rank(c):
+                return (not c[1].startswith(prefix), len(c[1]), c[1])
+        if limit and len(matches) > limit:
+            return heapq.nsmallest(limit, matches, key = rank)
+        return sorted(matches, key = rank)
+
+
+class CompletionRanker(object):
+    """
+    Ranks completions for file by context: declarations of file itself first, then ones from explicitly imported modules,
+    recently used completions are raised
+    Completions know only module they are imported from, so type class membership is not taken into account
+    """
+    local_score = 4
+    import_score = 2
+    recent_score = 3
+    case_score = 1
+
+    def __init__(self, module_name = None, imports = None, recent = None):
+        self.module_name = module_name
+        self.imports = imports or set()
+        self.recent = recent or set()
+
+    def rank(self, prefix):
+        """ Rank key function for CompletionIndex.prefixed: better score, then shorter name """
+        module_name = self.module_name
+        imports = self.imports
+        recent = self.recent
+
+        def rank_key(c):
+            origin = c[0].rpartition('\t')[2]
+            score = 0
+            if not origin or origin == module_name:
+                score -= CompletionRanker.local_score
+            elif origin in imports:
+                score -= CompletionRanker.import_score
+            if c[1] in recent:
+                score -= CompletionRanker.recent_score
+            if c[1].startswith(prefix):
+                score -= CompletionRanker.case_score
+            return (score, len(c[1]), c[1])
+        return rank_key
+
+
+class ModuleTree(object):
+    """
+    Module names, split by dots into tree, so that names for prefix are found by walking segments
+    """
+    def __init__(self, names = []):
+        self.names = set()
+        self.root = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        self.names.add(name)
+        node = self.root
+        for part in name.split('.'):
+            node = node.setdefault(part, {})
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def next_names(self, prefix):
+        """ Segments of module names, following prefix: for 'Control.Con' they are 'Concurrent', ... """
+        parts = prefix.split('.')
+        node = self.root
+        for part in parts[:-1]:
+            node = node.get(part)
+            if node is None:
+                return []
+        return [p for p in node if p.startswith(parts[-1])]
+
+    def has_prefix(self, prefix):
+        return len(self.next_names(prefix)) > 0
+
+
+class CompletionPool(object):
+    """
+    Completion tuples, shared between files: most of completions are imported declarations, same in many files
+    Each tuple is counted by number of files using it and is removed when last of them is dropped
+    """
+    def __init__(self):
+        self.tuples = {}  # completion ⇒ [shared completion, number of uses]
+        self.bytes = 0
+        self.hits = 0
+
+    def share(self, keyed):
+        """ Replace completions in keyed completions list with shared ones """
+        result = []
+        for (k, c) in keyed:
+            entry = self.tuples.get(c)
+            if entry is None:
+                entry = [c, 0]
+                self.tuples[c] = entry
+                self.bytes += completion_size(c)
+            else:
+                self.hits += 1
+            entry[1] += 1
+            result.append((k, entry[0]))
+        return result
+
+    def release(self, comps):
+        for c in comps:
+            entry = self.tuples.get(c)
+            if entry is None:
+                continue
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.tuples[c]
+                self.bytes -= completion_size(c)
+
+    def clear(self):
+        self.tuples.clear()
+        self.bytes = 0
+
+
 class CompletionCache(object):
+    """
+    Completions for files in LRU order, limited by number of files and by memory
+    """
     def __init__(self):
-        self.files = {}
+        self.files = OrderedDict()  # filename ⇒ CompletionIndex, least recently used first
+        self.sizes = {}  # filename ⇒ size of file's index
+        self.pool = CompletionPool()
+        self.file_modules = {}  # filename ⇒ module name
+        self.file_imports = {}  # filename ⇒ set of imported modules names
+        self.file_infos = {}  # filename ⇒ (imports key, project), see file_info
+        self.qualified = {}  # filename ⇒ (imports key, {(is import list, module) ⇒ CompletionIndex})
+        self.prefetched = {}  # filename ⇒ size of completions, prepared by prefetch and not used yet
+        self.module_runs = OrderedDict()  # run key ⇒ (module stamp, module file, keyed completions, size, last use), least recently used first, see module_run
+        self.module_runs_bytes = 0
+        self.file_uses = {}  # filename ⇒ last use, files and module runs are evicted in order of last use
+        self.uses = 0
         self.cabal = []
         self.sources = []
-        self.global_comps = []
-
-    def set_files(self, filename, comps):
-        self.files[filename] = comps
+        self.global_comps = None  # built on demand
+        self.global_idx = None
+        self.stats = {'invalidations': 0, 'dropped': 0, 'rebuilds_avoided': 0, 'prefetched': 0, 'prefetch_hits': 0, 'evicted': 0, 'qualified_hits': 0, 'qualified_misses': 0, 'module_run_hits': 0, 'module_run_misses': 0}
+
+    max_module_runs = 5000
+
+    def set_files(self, filename, keyed, module = None, prefetch = False):
+        """ Set sorted keyed completions for file """
+        self.drop_files(filename)
+        index = CompletionIndex(self.pool.share(keyed))
+        self.files[filename] = index
+        self.file_uses[filename] = self.use()
+        self.update_size(filename)
+        if prefetch:
+            self.prefetched[filename] = completions_size(index.comps)
+            self.stats['prefetched'] += 1
+        if module:
+            self.set_file_info(filename, module)
+        self.evict(keep = filename)
+
+    def set_file_info(self, filename, module):
+        self.file_modules[filename] = module.name
+        self.file_imports[filename] = set(i.module for i in module.imports)
+        imports_key = tuple(sorted((i.module, i.is_qualified, i.import_as or '') for i in module.imports))
+        self.file_infos[filename] = (imports_key, module.location.project if module.location else None)
+
+    def file_info(self, filename):
+        """ Imports key and project of file or None if unknown """
+        return self.file_infos.get(filename)
+
+    def get_qualified(self, filename, key):
+        """ Memoized qualified completions for file, valid while file's imports are the same """
+        info = self.file_infos.get(filename)
+        memo = self.qualified.get(filename)
+        if info is None or memo is None or memo[0] != info[0]:
+            self.stats['qualified_misses'] += 1
+            return None
+        index = memo[1].get(key)
+        self.stats['qualified_hits' if index is not None else 'qualified_misses'] += 1
+        return index
+
+    def set_qualified(self, filename, key, keyed):
+        """ Memoize sorted keyed qualified completions for file """
+        info = self.file_infos.get(filename)
+        if info is None:
+            return CompletionIndex(keyed)
+        memo = self.qualified.get(filename)
+        if memo is None or memo[0] != info[0]:
+            self.release_qualified(filename)
+            memo = (info[0], {})
+            self.qualified[filename] = memo
+        index = CompletionIndex(self.pool.share(keyed))
+        if key in memo[1]:
+            self.pool.release(memo[1][key].comps)
+        memo[1][key] = index
+        self.update_size(filename)
+        self.evict(keep = filename)
+        return index
+
+    def module_run(self, key, stamp):
+        """
+        Sorted keyed completions of declarations of one module, imported to file from one module, or None
+        key — (imported from, defining module key, names of declarations), same in all files, that import same declarations
+        Run is valid while stamp of defining module is the same
+        """
+        entry = self.module_runs.get(key)
+        if entry is None or entry[0] != stamp:
+            self.stats['module_run_misses'] += 1
+            return None
+        self.pop_module_run(key)
+        self.module_runs[key] = entry[:4] + (self.use(),)
+        self.module_runs_bytes += entry[3]
+        self.stats['module_run_hits'] += 1
+        return entry[2]
+
+    def set_module_run(self, key, stamp, filename, keyed):
+        self.pop_module_run(key)
+        size = sys.getsizeof(keyed) + sum(sys.getsizeof(p) + completion_size(p[1]) for p in keyed)
+        self.module_runs[key] = (stamp, filename, keyed, size, self.use())
+        self.module_runs_bytes += size
+        while len(self.module_runs) > CompletionCache.max_module_runs:
+            self.pop_module_run(next(iter(self.module_runs)))
+        self.evict()
+
+    def pop_module_run(self, key):
+        entry = self.module_runs.pop(key, None)
+        if entry is not None:
+            self.module_runs_bytes -= entry[3]
+
+    def drop_module_runs(self, files = None):
+        """ Drop runs of modules, defined in files, or of all source modules """
+        for key in [k for k, entry in self.module_runs.items() if entry[1] is not None and (files is None or entry[1] in files)]:
+            self.pop_module_run(key)
+
+    def use(self):
+        """ Counter of uses, to compare last uses of files and module runs """
+        self.uses += 1
+        return self.uses
+
+    def update_size(self, filename):
+        """ Size of file's index and its memoized qualified indices """
+        size = self.files[filename].size() if filename in self.files else 0
+        memo = self.qualified.get(filename)
+        if memo is not None:
+            size += sum(index.size() for index in memo[1].values())
+        self.sizes[filename] = size
+
+    def release_qualified(self, filename):
+        memo = self.qualified.pop(filename, None)
+        if memo is not None:
+            for index in memo[1].values():
+                self.pool.release(index.comps)
+
+    def get_files(self, filename):
+        """ Completions for file or None, marks file as recently used """
+        index = self.files.pop(filename, None)
+        if index is None:
+            return None
+        self.files[filename] = index
+        self.file_uses[filename] = self.use()
+        return index.comps
+
+    def drop_files(self, filename = None):
+        if filename is None:
+            self.files.clear()
+            self.sizes.clear()
+            self.pool.clear()
+            self.file_modules.clear()
+            self.file_imports.clear()
+            self.file_infos.clear()
+            self.qualified.clear()
+            self.prefetched.clear()
+            self.file_uses.clear()
+            self.drop_module_runs()
+        else:
+            index = self.files.pop(filename, None)
+            if index is not None:
+                self.pool.release(index.comps)
+            self.release_qualified(filename)
+            self.sizes.pop(filename, None)
+            self.file_modules.pop(filename, None)
+            self.file_imports.pop(filename, None)
+            self.file_infos.pop(filename, None)
+            self.prefetched.pop(filename, None)
+            self.file_uses.pop(filename, None)
+
+    def size(self):
+        return sum(self.sizes.values()) + self.pool.bytes + self.module_runs_bytes
+
+    def evict(self, keep = None):
+        """
+        Drop least recently used files and module runs until cache fits limits
+        Number of files is limited separately, size limits files and runs together
+        """
+        max_files = get_setting_async('completions_cache_files', 100)
+        max_size = get_setting_async('completions_cache_size', 128) * 1024 * 1024
+        files = [f for f in list(self.files.keys()) + [f for f in self.qualified if f not in self.files] if f != keep]
+        while files:
+            too_many = max_files and len(self.files) > max_files
+            if not too_many and (not max_size or self.size() <= max_size):
+                return
+            run = next(iter(self.module_runs), None)
+            if not too_many and run is not None and self.module_runs[run][4] < self.file_uses.get(files[0], 0):
+                self.pop_module_run(run)
+                continue
+            filename = files.pop(0)
+            log('evict completions for {0}'.format(filename), log_trace)
+            self.drop_files(filename)
+            self.stats['evicted'] += 1
+        while self.module_runs and max_size and self.size() > max_size:
+            self.pop_module_run(next(iter(self.module_runs)))
+
+    def use_file(self, filename):
+        """ Completions for file requested, they are not speculative anymore """
+        if self.prefetched.pop(filename, None) is not None:
+            self.stats['prefetch_hits'] += 1
+
+    def prefetched_size(self):
+        return sum(self.prefetched.values())
+
+    def dependent_files(self, files, modules):
+        """
+        Files, which completions depend on changed files: files themselves and files, importing their modules
+        Imports are followed transitively, because modules can reexport
+        """
+        result = set(files)
+        modules = set(modules) | set(self.file_modules[f] for f in files if f in self.file_modules)
+        changed = True
+        while changed:
+            changed = False
+            for f, imports in self.file_imports.items():
+                if f not in result and imports & modules:
+                    result.add(f)
+                    if f in self.file_modules:
+                        modules.add(self.file_modules[f])
+                    changed = True
+        return result
+
+    def invalidate(self, files, modules = []):
+        """ Drop completions of changed files and of files, depending on them """
+        dropped = self.dependent_files(files, modules)
+        cached = len(self.files)
+        for f in dropped:
+            self.drop_files(f)
+        self.drop_module_runs(set(files))
+        self.stats['invalidations'] += 1
+        self.stats['dropped'] += cached - len(self.files)
+        self.stats['rebuilds_avoided'] += len(self.files)
+        return dropped
 
     def set_cabal(self, comps):
-        self.cabal = comps
-        self.global_comps = sorted_completions(self.cabal + self.sources)
+        self.cabal = keyed_completions(comps)
+        self.global_comps = None
+        self.global_idx = None
 
     def set_sources(self, comps):
-        self.sources = comps
-        self.global_comps = sorted_completions(self.cabal + self.sources)
+        self.sources = keyed_completions(comps)
+        self.global_comps = None
+        self.global_idx = None
 
     def set_locs(self, locs):
         self.source_locs = locs
 
-    def global_completions(self):
+    def global_keyed(self):
+        if self.global_comps is None:
+            self.global_comps = merge_completions(self.cabal, self.sources)
         return self.global_comps
 
+    def global_completions(self):
+        return self.global_index().comps
+
+    def global_index(self):
+        if self.global_idx is None:
+            self.global_idx = CompletionIndex(self.global_keyed())
+        return self.global_idx
+
+    def file_index(self, filename):
+        """ Index of completions for file, global one if there are no completions for file yet """
+        if filename in self.files:
+            return self.files[filename]
+        return self.global_index()
+
+    def cache_stats(self):
+        return {
+            'files': len(self.files),
+            'bytes': self.size(),
+            'pooled_completions': len(self.pool.tuples),
+            'module_runs': len(self.module_runs),
+            'module_runs_bytes': self.module_runs_bytes,
+            'pool_bytes': self.pool.bytes,
+            'pool_hits': self.pool.hits}
+
 
 # Autocompletion data
 class AutoCompletion(object):
@@ -121,7 +598,7 @@ class AutoCompletion(object):
         self.language_pragmas = []
         self.flags_pragmas = []
 
-        # cabal name => set of modules, where cabal name is 'cabal' for cabal or sandbox path for cabal-devs
+        # scope => ModuleTree of modules, where scope is ('file', filename), ('dir', path) or ('cabal',)
         self.module_completions = LockedObject({})
 
         # keywords
@@ -136,11 +613,30 @@ class AutoCompletion(object):
         self.cache = LockedObject(CompletionCache())
         self.wide_completion = None
 
+        # recently used completions, most recent last
+        self.recent = LockedObject(OrderedDict())
+
     def mark_wide_completion(self, view):
         self.wide_completion = view
 
+    max_recent = 100
+
+    def mark_used(self, name):
+        """ Remember completion, inserted by user, to raise it in ranking """
+        with self.recent as recent:
+            recent.pop(name, None)
+            recent[name] = True
+            while len(recent) > AutoCompletion.max_recent:
+                recent.popitem(last = False)
+
+    def ranker(self, filename = None):
+        with self.recent as recent:
+            recent_names = set(recent.keys())
+        with self.cache as cache_:
+            return CompletionRanker(cache_.file_modules.get(filename), cache_.file_imports.get(filename), recent_names)
+
     @hsdev.use_hsdev([])
-    def get_completions_async(self, file_name = None):
+    def get_completions_async(self, file_name = None, prefetch = False):
         def log_result(r):
             log('completions: {0}'.format(len(r or [])), log_trace)
             return (r or [])
@@ -149,7 +645,9 @@ class AutoCompletion(object):
         update_sources = False
         with self.cache as cache_:
             if file_name in cache_.files:
-                return log_result(cache_.files.get(file_name, []))
+                if not prefetch:
+                    cache_.use_file(file_name)
+                return log_result(cache_.get_files(file_name))
             else:
                 update_cabal = not cache_.cabal
                 update_sources = not cache_.sources
@@ -158,39 +656,137 @@ class AutoCompletion(object):
         if update_sources:
             self.update_sources_completions()
         with self.cache as cache_:
-            none_comps = cache_.global_completions()
+            none_comps = cache_.global_keyed()
 
         import_names = []
         comps = none_comps
 
         if file_name is None:
-            return log_result(none_comps)
+            return log_result(unkeyed(none_comps))
         else:
             log('preparing completions for {0}'.format(file_name), log_debug)
-            current_module = head_of(hsdev.client_back.module(file = file_name))
+            # Prefetch is speculative, it goes through background lane and doesn't delay completions for active view
+            client = hsdev.client_scan if prefetch else hsdev.client_back
+            (current_modules, current_comps) = client.batch([
+                client.module(file = file_name, future = True),
+                client.complete('', file_name, future = True)])
+            current_module = head_of(current_modules or [])
             if current_module:
-                comps = make_completions(
-                    hsdev.client_back.complete('', file_name, timeout = None))
+                comps = self.module_runs_completions(current_comps)
 
                 # Get imports names
                 # Note, that if module imported with 'as', then it can be used only with its synonym instead of full name
                 import_names.extend([('{0}\tmodule {1}'.format(i.import_as, i.module), i.import_as) for i in current_module.imports if i.import_as])
                 import_names.extend([('{0}\tmodule'.format(i.module), i.module) for i in current_module.imports if not i.import_as])
 
-                comps.extend(import_names)
-                sort_completions(comps)
+                comps = merge_completions(comps, keyed_completions(import_names))
+
+        with self.cache as cache_:
+            cache_.set_files(file_name, comps, current_module, prefetch = prefetch)
+            result = cache_.get_files(file_name)
+        snapshot_writer.schedule()
+        return log_result(result)
+
+    def module_runs_completions(self, decls):
+        """
+        Sorted keyed completions for declarations, merged from runs of declarations of same module
+        Runs are cached, so completions of modules, imported by many files, are built and sorted once
+        """
+        # Module ids are interned, so declarations are grouped by module object
+        groups = {}
+        for d in decls or []:
+            if d:
+                groups.setdefault((d.imported_from_name(), d.defined_module()), []).append(d)
+        stamps = {}
+        for (_, m) in groups.keys():
+            if m is not None and m not in stamps:
+                stamps[m] = (symbol_index.module_key(m), module_stamp(m))
+
+        runs = []
+        missing = []
+        with self.cache as cache_:
+            for (imported_from, m), ds in groups.items():
+                if m is None:
+                    missing.append((None, None, ds))
+                    continue
+                (mkey, stamp) = stamps[m]
+                key = (imported_from, mkey, frozenset(d.name for d in ds))
+                run = cache_.module_run(key, stamp)
+                if run is None:
+                    missing.append((key, m, ds))
+                else:
+                    runs.append(run)
+        built = [(key, m, declarations_completions(ds)) for (key, m, ds) in missing]
+        with self.cache as cache_:
+            for (key, m, run) in built:
+                if m is not None and stamps[m][1] is not None:
+                    cache_.set_module_run(key, stamps[m][1], m.location.filename if m.by_source() else None, run)
+        return merge_completions(*(runs + [run for (_, _, run) in built]))
 
+    def prefetch_completions_async(self, file_name):
+        """
+        Prepare completions for file in background unless prefetched completions exceed memory budget
+        Returns False if budget is exceeded
+        """
+        with self.cache as cache_:
+            if file_name in cache_.files:
+                return True
+            if cache_.prefetched_size() >= get_setting_async('prefetch_completions_budget', 32) * 1024 * 1024:
+                return False
+        log('prefetching completions for {0}'.format(file_name), log_trace)
+        self.get_completions_async(file_name, prefetch = True)
+        return True
+
+    def drop_module_runs(self, files = None):
+        """ Drop completion runs of modules, defined in files, or of all source modules """
         with self.cache as cache_:
-            cache_.files[file_name] = comps
-            return log_result(cache_.files[file_name])
+            cache_.drop_module_runs(None if files is None else set(files))
 
     def drop_completions_async(self, file_name = None):
         log('drop prepared completions')
         with self.cache as cache_:
-            if file_name is None:
-                cache_.files.clear()
-            elif file_name in cache_.files:
-                del cache_.files[file_name]
+            cache_.drop_files(file_name)
+
+    def invalidate_completions_async(self, files):
+        """ Drop completions for changed files and files, that import them """
+        with self.cache as cache_:
+            unknown = [f for f in files if f not in cache_.file_modules]
+        # Module names of files, which completions were not prepared, are needed to find dependent files
+        modules = []
+        for f in unknown:
+            m = head_of(hsdev.client_back.module(file = f)) if hsdev.agent_connected() else None
+            if m:
+                modules.append(m.name)
+        with self.cache as cache_:
+            dropped = cache_.invalidate(files, modules)
+        log('drop prepared completions for {0}'.format(', '.join(dropped)), log_debug)
+
+    def save_snapshot(self):
+        groups = symbol_index.index.groups()
+        with self.cache as cache_:
+            snapshot.save(cache_, groups)
+        log('snapshot saved', log_debug)
+
+    def restore_snapshot_async(self):
+        """ Load completions and symbols from snapshot, they are replaced when hsdev rescans files """
+        snap = snapshot.load()
+        if snap is None:
+            return
+
+        def set_files(filename, comps, module):
+            with self.cache as cache_:
+                if filename not in cache_.files:
+                    cache_.set_files(filename, keyed_completions(comps), module)
+        (modules, files) = snapshot.restore(snap, set_files)
+        log('snapshot loaded: {0} modules, completions for {1} files'.format(modules, files), log_info)
+
+    def completions_stats(self):
+        with self.cache as cache_:
+            result = dict(cache_.stats, prefetched_files = len(cache_.prefetched), prefetched_bytes = cache_.prefetched_size())
+            result.update(cache_.cache_stats())
+        with self.module_completions as module_completions:
+            result['module_scopes'] = len(module_completions)
+        return result
 
     def update_cabal_completions(self):
         pass
@@ -207,16 +803,20 @@ class AutoCompletion(object):
                 if filename:
                     self.get_completions_async(filename)
 
-    @hsdev.use_hsdev([])
     def get_completions(self, view, prefix, locations):
         "Get all the completions that related to the current file."
 
+        # Prepared completions (maybe loaded from snapshot) are used even when hsdev is not connected yet
+        if not get_setting_async('enable_hsdev'):
+            return []
+
         current_file_name = view.file_name()
 
         if not current_file_name:
             return []
 
         self.current_filename = current_file_name
+        prefetcher.interactive()
         line_contents = get_line_contents(view, locations[0])
         qsymbol = get_qualified_symbol(line_contents)
         qualified_prefix = qsymbol.qualified_name()
@@ -228,31 +828,54 @@ class AutoCompletion(object):
             self.wide_completion = None
 
         if qsymbol.module:
-            current_module = head_of(hsdev.client.module(file = current_file_name))
-            current_project = None
-            if current_module:
-                current_project = current_module.location.project
+            if not hsdev.agent_connected():
+                return self.keyword_completions
+            if wide:
+                suggestions = hsdev.client.complete(qualified_prefix, current_file_name, wide = wide, supersede = ('complete', current_file_name)) or []
+                return self.keyword_completions + make_completions(suggestions)
+            # Completions for module or qualifier are memoized per file, they are the same while file's imports are the same
+            memo_key = (qsymbol.is_import_list, qsymbol.module)
+            with self.cache as cache_:
+                info = cache_.file_info(current_file_name)
+                index = cache_.get_qualified(current_file_name, memo_key)
+            if index is None:
+                if info is None:
+                    current_module = head_of(hsdev.client.module(file = current_file_name))
+                    if not current_module:
+                        return self.keyword_completions
+                    with self.cache as cache_:
+                        cache_.set_file_info(current_file_name, current_module)
+                        info = cache_.file_info(current_file_name)
+                current_project = info[1]
+                suggestions = None
                 if qsymbol.is_import_list:
                     if current_project:
                         # Search for declarations of qsymbol.module within current project
                         q_module = head_of(hsdev.client.scope_modules(file = current_file_name, input = qsymbol.module, search_type = 'exact'))
-                        if q_module.by_source():
+                        if q_module and q_module.by_source():
                             proj_module = hsdev.client.resolve(file = q_module.location.filename, exports = True)
                             if proj_module:
                                 suggestions = proj_module.declarations.values()
-                        elif q_module.by_cabal():
+                        elif q_module and q_module.by_cabal():
                             cabal_module = head_of(hsdev.client.module(q_module.name, search_type = 'exact', package = q_module.location.package.name))
                             if cabal_module:
                                 suggestions = cabal_module.declarations.values()
                 else:
-                    suggestions = hsdev.client.complete(qualified_prefix, current_file_name, wide = wide)
-            return self.keyword_completions + make_completions(suggestions)
+                    # All declarations, accessible with qualifier, then filtered by typed name
+                    suggestions = hsdev.client.complete('{0}.'.format(qsymbol.module), current_file_name, supersede = ('complete', current_file_name))
+                if suggestions is None:  # Not resolved, don't memoize
+                    return self.keyword_completions
+                with self.cache as cache_:
+                    index = cache_.set_qualified(current_file_name, memo_key, declarations_completions(suggestions))
+            name = qsymbol.name or ''
+            return self.keyword_completions + index.prefixed(name, get_setting_async('completions_limit', 200), self.ranker(current_file_name).rank(name))
         else:
+            limit = get_setting_async('completions_limit', 200)
+            keywords = [k for k in self.keyword_completions if k[1].startswith(prefix)]
+            rank = self.ranker(None if wide else current_file_name).rank(prefix)
             with self.cache as cache_:
-                if wide:
-                    return self.keyword_completions + cache_.global_completions()
-                else:
-                    return self.keyword_completions + cache_.files.get(current_file_name, cache_.global_completions())
+                index = cache_.global_index() if wide else cache_.file_index(current_file_name)
+            return keywords + index.prefixed(prefix, limit, rank)
 
     @hsdev.use_hsdev([])
     def completions_for_module(self, module, filename = None):
@@ -345,35 +968,135 @@ class AutoCompletion(object):
             # Sublime replaces full module name with suffix, if it contains no dots?
             return suffix[0]
 
-        module_list = modules if modules else self.get_current_module_completions(current_dir = current_dir)
-        return list(set((module_next_name(m) + '\tmodule', module_next_name(m)) for m in module_list if m.startswith(qualified_prefix)))
+        if modules:
+            return list(set((module_next_name(m) + '\tmodule', module_next_name(m)) for m in modules if m.startswith(qualified_prefix)))
+        tree = self.get_current_module_tree(current_dir = current_dir)
+        return [(n + '\tmodule', n) for n in tree.next_names(qualified_prefix)]
 
-    @hsdev.use_hsdev([])
     def get_current_module_completions(self, current_dir = None):
+        return self.get_current_module_tree(current_dir = current_dir).names
+
+    @hsdev.use_hsdev(ModuleTree())
+    def get_current_module_tree(self, current_dir = None):
         """
-        Get modules, that are in scope of file/project
+        Get modules, that are in scope of file/project, cached per scope until agent rescans it
         In case of file we just return 'scope modules' result
         In case of dir we look for a related project or sandbox:
             project - get dependent modules
             sandbox - get sandbox modules
         """
         if self.current_filename:
-            return set([m.name for m in hsdev.client.scope_modules(self.current_filename)])
+            scope = ('file', self.current_filename)
+        elif current_dir:
+            scope = ('dir', current_dir)
+        else:
+            scope = ('cabal',)
+        with self.module_completions as module_completions:
+            if scope in module_completions:
+                return module_completions[scope]
+
+        modules = None
+        if self.current_filename:
+            modules = hsdev.client.scope_modules(self.current_filename)
         elif current_dir:
             proj = hsdev.client.project(path = current_dir)
             if proj and 'path' in proj:
-                return set([m.name for m in hsdev.client.list_modules(deps = proj['path'])])
-            sbox = hsdev.client.sandbox(path = current_dir)
-            if sbox and type(sbox) == dict and 'sandbox' in sbox:
-                sbox = sbox.get('sandbox')
-            if sbox:
-                return set([m.name for m in hsdev.client.list_modules(sandbox = sbox)])
+                modules = hsdev.client.list_modules(deps = proj['path'])
+            else:
+                sbox = hsdev.client.sandbox(path = current_dir)
+                if sbox and type(sbox) == dict and 'sandbox' in sbox:
+                    sbox = sbox.get('sandbox')
+                if sbox:
+                    modules = hsdev.client.list_modules(sandbox = sbox)
         else:
-            return set([m.name for m in hsdev.client.list_modules(cabal = True)])
+            modules = hsdev.client.list_modules(cabal = True)
+        tree = ModuleTree([m.name for m in modules or []])
+        if modules is not None:
+            with self.module_completions as module_completions:
+                module_completions[scope] = tree
+        return tree
+
+    def drop_module_completions(self, files = None):
+        """ Drop module names of rescanned files' scopes, or all if files not specified """
+        with self.module_completions as module_completions:
+            if files is None:
+                module_completions.clear()
+            else:
+                # New source modules can appear in any project, but installed modules are the same
+                for scope in [s for s in module_completions if s[0] != 'cabal']:
+                    del module_completions[scope]
 
 autocompletion = AutoCompletion()
 
 
+class CompletionPrefetcher(threading.Thread):
+    """
+    Prepares completions for open and recently used Haskell files in background,
+    so that they are ready when user switches to file
+    It uses background hsdev client, waits while user is typing and stops when memory budget is exhausted
+    """
+    idle_timeout = 1.0  # seconds since last interactive completion
+    sleep_timeout = 10.0
+
+    def __init__(self, completion):
+        super(CompletionPrefetcher, self).__init__()
+        self.daemon = True
+        self.completion = completion
+        self.recent = LockedObject([])  # most recently used files first
+        self.last_interactive = 0
+        self.prefetch_event = threading.Event()
+
+    def touch(self, filename):
+        with self.recent as recent:
+            if filename in recent:
+                recent.remove(filename)
+            recent.insert(0, filename)
+            del recent[max(get_setting_async('prefetch_recent_files', 10), 0):]
+        self.wake()
+
+    def wake(self):
+        if not self.is_alive():
+            try:
+                self.start()
+            except RuntimeError:  # started by another thread
+                pass
+        self.prefetch_event.set()
+
+    def interactive(self):
+        self.last_interactive = time.time()
+
+    def files(self):
+        """ Recently used files, then other open Haskell files """
+        with self.recent as recent:
+            result = recent[:]
+        for w in sublime.windows():
+            for v in w.views():
+                filename = v.file_name()
+                if filename and filename not in result and is_haskell_source(v):
+                    result.append(filename)
+        return result
+
+    def run(self):
+        while True:
+            self.prefetch_event.wait(CompletionPrefetcher.sleep_timeout)
+            self.prefetch_event.clear()
+            if not get_setting_async('prefetch_completions') or not hsdev.agent_connected():
+                continue
+            for f in self.files():
+                # Interactive requests go first
+                while time.time() - self.last_interactive < CompletionPrefetcher.idle_timeout:
+                    time.sleep(CompletionPrefetcher.idle_timeout)
+                try:
+                    if not self.completion.prefetch_completions_async(f):
+                        break
+                except Exception as e:
+                    log('prefetching completions for {0} failed: {1}'.format(f, e), log_debug)
+
+
+prefetcher = CompletionPrefetcher(autocompletion)
+snapshot_writer = snapshot.SnapshotWriter(autocompletion.save_snapshot)
+
+
 def can_complete_qualified_symbol(info):
     """
     Helper function, returns whether sublime_haskell_complete can run for (module, symbol, is_import_list)
@@ -384,16 +1107,31 @@ def can_complete_qualified_symbol(info):
     if info.is_import_list:
         return info.module in autocompletion.get_current_module_completions()
     else:
-        return list(filter(lambda m: m.startswith(info.module), autocompletion.get_current_module_completions())) != []
+        return autocompletion.get_current_module_tree().has_prefix(info.module)
+
+
+hsdev.register_stats('completions', autocompletion.completions_stats)
 
 
 def update_completions_async(files = [], drop_all = False):
+    """ Drop completions for all files or for changed files and files, depending on them """
+    # Runs are dropped at once: they are keyed by modification time, which doesn't change when editor contents are scanned
+    autocompletion.drop_module_runs(None if drop_all else files)
     if drop_all:
         run_async('drop all completions', autocompletion.drop_completions_async)
-    else:
-        for f in files:
-            run_async('drop completions', autocompletion.drop_completions_async, f)
+    elif files:
+        run_async('invalidate completions', autocompletion.invalidate_completions_async, files)
     run_async('init completions', autocompletion.init_completions_async)
+    prefetcher.wake()
+    snapshot_writer.schedule()
+
+
+def on_inspected(files):
+    autocompletion.drop_module_completions(files)
+    update_completions_async(files = files or [], drop_all = files is None)
+
+
+hsdev.add_inspected_listener(on_inspected)
 
 
 class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
@@ -446,11 +1184,17 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
                 # TODO: Set some useful status instead of this
                 view.set_status('sublime_haskell_cabal', '{0}: {1}'.format('cabal', project_name))
 
+    def on_post_text_command(self, view, command_name, args):
+        if command_name in ['commit_completion', 'insert_best_completion'] and is_haskell_source(view):
+            region = view.word(view.sel()[0].b)
+            autocompletion.mark_used(view.substr(region))
+
     def on_activated_async(self, view):
         if is_haskell_source(view):
             filename = view.file_name()
             if filename:
                 run_async('get completions for {0}'.format(filename), autocompletion.get_completions_async, filename)
+                prefetcher.touch(filename)
 
     def on_new(self, view):
         hsdev.start_agent()
@@ -459,8 +1203,8 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
         if is_inspected_source(view):
             filename = view.file_name()
             if filename:
+                # Completions of this file and dependent ones are dropped when agent rescans it
                 hsdev.agent.mark_file_dirty(filename)
-                update_completions_async(drop_all = True)
 
     def on_load(self, view):
         hsdev.start_agent()
@@ -469,8 +1213,8 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
         if is_inspected_source(view):
             filename = view.file_name()
             if filename:
+                # Completions of this file and dependent ones are dropped when agent rescans it
                 hsdev.agent.mark_file_dirty(filename)
-                update_completions_async(drop_all = True)
 
     def on_activated(self, view):
         hsdev.start_agent()
@@ -499,13 +1243,15 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
         if is_inspected_source(view):
             filename = view.file_name()
             if filename:
-                hsdev.agent.mark_file_dirty(filename)
-                update_completions_async(drop_all = True)
+                # Completions of this file and dependent ones are dropped when agent rescans it
+                hsdev.agent.mark_file_saved(filename)
 
 
 def plugin_loaded():
     # TODO: How to stop_hdevtools() in Sublime Text 2?
     start_hdevtools()
+    if get_setting('completions_snapshot'):
+        run_async('load snapshot', autocompletion.restore_snapshot_async)
 
 
 def plugin_unloaded():
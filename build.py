@@ -205,7 +205,8 @@ def run_build(view, project_name, project_dir, config):
         # Set project as done being built so that it can be built again
         projects_being_built.remove(project_name)
 
-    # Run them
+    # Run them, build messages replace ones of fly checks
+    hsdev.content_hashes.drop('check')
     run_chain_build_thread(
         view,
         project_dir,
@@ -368,6 +369,7 @@ def run_build_commands_with(msg, cmds):
     if not cabal_project_dir:
         return
 
+    hsdev.content_hashes.drop('check')
     run_chain_build_thread(view, cabal_project_dir, msg(cabal_project_name), cmds)
 
 
@@ -53,7 +53,15 @@ class SublimeHaskellHsDevChain(SublimeHaskellTextCommand):
         self.contents = {}
         if self.view.is_dirty():
             self.contents[self.filename] = self.view.substr(sublime.Region(0, self.view.size()))
-        if not self.fly_mode:
+        self.check_digest = None
+        if self.fly_mode:
+            # Fly check of same contents with same options, messages are still shown
+            self.check_digest = hsdev.content_digest(
+                self.view.substr(sublime.Region(0, self.view.size())),
+                [msg] + [kwargs for (_, _, _, kwargs) in cmds])
+            if hsdev.content_hashes.unchanged('check', self.filename, self.check_digest):
+                return
+        else:
             hide_output(self.view)
         if not cmds:
             return
@@ -71,6 +79,10 @@ class SublimeHaskellHsDevChain(SublimeHaskellTextCommand):
         try:
             if not cmds:
                 self.status_msg.stop()
+                # Messages and marks of all views are replaced, so checks of other files must show theirs again
+                hsdev.content_hashes.drop('check')
+                if self.check_digest is not None:
+                    hsdev.content_hashes.update('check', self.filename, self.check_digest)
                 output_messages = [OutputMessage(
                     m['source']['file'],
                     OutputPoint(
@@ -105,9 +117,14 @@ class SublimeHaskellHsDevChain(SublimeHaskellTextCommand):
 
                 def on_err(err, ds):
                     self.status_msg.fail()
+                    self.check_digest = None
                     self.go_chain([])
 
-                fn(modify_args(self.filename), contents = self.contents, wait = False, on_response = on_resp, on_error = on_err, **kwargs)
+                def on_cancel():
+                    # Superseded by newer request for same file, drop stale results
+                    self.status_msg.stop()
+
+                fn(modify_args(self.filename), contents = self.contents, wait = False, on_response = on_resp, on_error = on_err, on_cancel = on_cancel, supersede = (fn.__name__, self.filename), **kwargs)
         except Exception as e:
             log('hsdev chain fails with: {0}'.format(e), log_error)
             self.status_msg.fail()
@@ -258,8 +275,9 @@ def wait_ghcmod_and_parse(view, filename, msg, cmds_with_args, alter_messages_cb
 
     concated_messages = [m[1] for m in parsed_messages]
 
-    # Set global error list
+    # Set global error list, it replaces results of skipped fly checks
     set_global_error_messages(concated_messages)
+    hsdev.content_hashes.drop('check')
 
     sublime.set_timeout(lambda: mark_messages_in_views(concated_messages), 0)
 
@@ -8,11 +8,13 @@ if int(sublime.version()) < 3000:
     from sublime_haskell_common import *
     import autocomplete
     import symbols
+    import symbol_index
     import hsdev
 else:
     from SublimeHaskell.sublime_haskell_common import *
     import SublimeHaskell.autocomplete as autocomplete
     import SublimeHaskell.symbols as symbols
+    import SublimeHaskell.symbol_index as symbol_index
     import SublimeHaskell.hsdev as hsdev
 
 # Extract the filename, line, column from symbol info
@@ -136,11 +138,20 @@ class SublimeHaskellBrowseDeclarations(hsdev.HsDevTextCommand):
 
 
 class SublimeHaskellFindDeclarations(hsdev.HsDevWindowCommand):
+    def is_enabled(self):
+        # Symbol index can be loaded from snapshot before hsdev is connected
+        if get_setting_async('enable_hsdev') and not symbol_index.index.is_empty():
+            return SublimeHaskellWindowCommand.is_enabled(self)
+        return hsdev.HsDevWindowCommand.is_enabled(self)
+
     def run(self):
         self.window.show_input_panel("Search string", "", self.on_done, self.on_change, self.on_cancel)
 
     def on_done(self, input):
-        self.decls = hsdev.client.symbol(input = input, search_type = 'regex')
+        if not symbol_index.index.is_empty():
+            self.decls = [e.declaration() for e in symbol_index.index.search(input, limit = 1000)]
+        else:
+            self.decls = hsdev.client.symbol(input = input, search_type = 'regex')
         if not self.decls:
             show_status_message("Nothing found for: {0}".format(input))
             return
@@ -203,7 +214,10 @@ class SublimeHaskellSearch(hsdev.HsDevWindowCommand):
         self.decls = []
         self.status_msg = status_message_process("Search '{0}'".format(self.input), priority = 3)
         self.status_msg.start()
-        hsdev.client.symbol(input = self.input, search_type = 'infix', wait = False, on_response = self.on_symbol, on_error = self.on_err)
+        if not symbol_index.index.is_empty():
+            self.on_symbol([e.declaration() for e in symbol_index.index.search(self.input, limit = 1000)])
+        else:
+            hsdev.client.symbol(input = self.input, search_type = 'infix', wait = False, on_response = self.on_symbol, on_error = self.on_err)
 
     def on_change(self, input):
         pass
@@ -251,10 +265,10 @@ class SublimeHaskellGoTo(hsdev.HsDevWindowCommand):
                 show_status_message('File {0} is not in project'.format(self.current_filename), False)
                 return
 
-            decls = self.sorted_decls_name(hsdev.client.symbol(project = current_project))
+            decls = self.sorted_decls_name(hsdev.client.symbol(project = current_project, stream = True))
             self.declarations = [[decl.brief(True), decl.module.name] for decl in decls]
         else:
-            decls = self.sorted_decls_pos(hsdev.client.symbol(file = self.current_filename, locals = True))
+            decls = self.sorted_decls_pos(hsdev.client.symbol(file = self.current_filename, locals = True, stream = True))
             self.declarations = [[(decl.position.column * ' ') + decl.brief(True)] for decl in decls]
         self.decls = decls[:]
 
@@ -298,7 +312,8 @@ class SublimeHaskellGoTo(hsdev.HsDevWindowCommand):
 
 class SublimeHaskellGoToModule(hsdev.HsDevWindowCommand):
     def run(self):
-        self.modules = hsdev.client.list_modules(source = True)
+        # Quick panel can't be extended after shown, but parts are parsed while others are still being received
+        self.modules = list(hsdev.client.list_modules(source = True, stream = True))
         self.window.show_quick_panel([[m.name if m.name != 'Main' else 'Main in {0}'.format(m.location.to_string()), m.location.to_string()] for m in self.modules], self.on_done, 0, 0, self.on_highlighted)
 
     def on_done(self, idx):
@@ -405,24 +420,84 @@ class SublimeHaskellReinspectAll(hsdev.HsDevWindowCommand):
             show_status_message("inspector not connected", is_ok = False)
 
 
+def format_hsdev_stats(stats):
+    lines = []
+    buckets = ['<= {0}s'.format(b) for b in hsdev.HsDevMetrics.latency_buckets] + ['> {0}s'.format(hsdev.HsDevMetrics.latency_buckets[-1])]
+    lines.append('hsdev commands:')
+    commands = sorted(stats['commands'].items(), key = lambda c: c[1]['latency'], reverse = True)
+    for name, m in commands:
+        finished = m['responses'] + m['errors']
+        lines.append('')
+        lines.append('  {0}: {1} calls, {2} responses, {3} errors, {4} cancelled'.format(name, m['calls'], m['responses'], m['errors'], m['cancelled']))
+        if finished:
+            lines.append('    latency: avg {0:.4f}s, max {1:.4f}s'.format(m['latency'] / finished, m['max_latency']))
+            lines.append('    histogram: {0}'.format(', '.join(['{0}: {1}'.format(b, n) for b, n in zip(buckets, m['histogram']) if n])))
+        lines.append('    bytes: {0} sent, {1} received, max response {2}'.format(m['request_bytes'], m['response_bytes'], m['max_response_bytes']))
+        lines.append('    json decode: {0:.4f}s, parse: {1:.4f}s'.format(m['decode_time'], m['parse_time']))
+    for name, section in sorted(stats.items()):
+        if name == 'commands':
+            continue
+        lines.append('')
+        lines.append('{0}:'.format(name))
+        for k, v in sorted(section.items()):
+            lines.append('  {0}: {1}'.format(k, v))
+    return '\n'.join(lines)
+
+
+class SublimeHaskellShowHsdevStats(SublimeHaskellWindowCommand):
+    """
+    Show hsdev client statistics: per-command latency, payload sizes, decode and parse time
+    If dump is set, also write them as JSON to cache directory
+    """
+    def run(self, dump = False):
+        stats = hsdev.collect_stats()
+        text = format_hsdev_stats(stats)
+        if dump:
+            path = os.path.join(sublime_haskell_cache_path(), 'hsdev-stats.json')
+            try:
+                with open(path, 'w') as f:
+                    json.dump(stats, f, indent = 2, sort_keys = True)
+                text = 'Stats dumped to {0}\n\n{1}'.format(path, text)
+            except (IOError, OSError) as e:
+                log('Unable to dump hsdev stats to {0}: {1}'.format(path, e), log_error)
+        output_panel(self.window, text, 'sublime_haskell_hsdev_stats')
+
+
 class SublimeHaskellScanContents(hsdev.HsDevTextCommand):
     """
     Scan module contents
     """
     def run(self, edit, filename = None):
         self.current_file_name = filename or self.view.file_name()
+        contents = self.view.substr(sublime.Region(0, self.view.size()))
+        # Same contents were already scanned
+        digest = hsdev.content_digest(contents)
+        if hsdev.content_hashes.unchanged('contents', self.current_file_name, digest):
+            return
         self.status_msg = status_message_process("Scanning {0}".format(self.current_file_name), priority = 3)
         self.status_msg.start()
 
         def on_resp(r):
             self.status_msg.stop()
+            hsdev.content_hashes.update('contents', self.current_file_name, digest)
+            # Scanned module is not the one on disk now, and checks may give other results
+            hsdev.content_hashes.drop('scan', [self.current_file_name])
+            hsdev.content_hashes.drop('check')
             update_completions_async([self.current_file_name])
 
         def on_err(r, ds):
             self.status_msg.fail()
             self.status_msg.stop()
 
-        hsdev.client.scan(contents = {self.current_file_name: self.view.substr(sublime.Region(0, self.view.size()))}, on_response = on_resp, on_error = on_err)
+        def on_cancel():
+            self.status_msg.stop()
+
+        hsdev.client.scan(
+            contents = {self.current_file_name: contents},
+            on_response = on_resp,
+            on_error = on_err,
+            on_cancel = on_cancel,
+            supersede = ('scan contents', self.current_file_name))
 
 
 class SublimeHaskellInferDocs(hsdev.HsDevTextCommand):
@@ -6,16 +6,29 @@ import threading
 import json
 import time
 import re
-from functools import reduce
+from functools import reduce, wraps
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from hashlib import blake2b as content_hash
+except ImportError:
+    from hashlib import sha1 as content_hash
 
 if int(sublime.version()) < 3000:
     import symbols
+    import symbol_index
+    import watcher
     from sublime_haskell_common import *
-    from worker import run_async
 else:
     import SublimeHaskell.symbols as symbols
+    import SublimeHaskell.symbol_index as symbol_index
+    import SublimeHaskell.watcher as watcher
     from SublimeHaskell.sublime_haskell_common import *
-    from SublimeHaskell.worker import run_async
 
 
 def concat_args(args):
@@ -164,11 +177,11 @@ def get_value(dc, ks, defval = None):
 def parse_package_db(d, defval = None):
     if type(d) == dict:
         pdb = get_value(d, 'package-db')
-        return symbols.PackageDb(package_db = pdb) if pdb else defval
+        return symbols.interned['package_dbs'].get(pdb, lambda: symbols.PackageDb(package_db = symbols.intern_string(pdb))) if pdb else defval
     if d == 'global-db':
-        return symbols.PackageDb(global_db = True)
+        return symbols.interned['package_dbs'].get(d, lambda: symbols.PackageDb(global_db = True))
     if d == 'user-db':
-        return symbols.PackageDb(user_db = True)
+        return symbols.interned['package_dbs'].get(d, lambda: symbols.PackageDb(user_db = True))
     return defval
 
 
@@ -182,7 +195,18 @@ def parse_position(d):
     return None
 
 
+def location_key(d):
+    db = d.get('db')
+    return (d.get('file'), d.get('project'), d.get('package'), db.get('package-db') if type(db) == dict else db, d.get('source'))
+
+
 def parse_location(d):
+    if not d:
+        return None
+    return symbols.interned['locations'].get(location_key(d), lambda: parse_location_(d))
+
+
+def parse_location_(d):
     loc = symbols.Location(
         get_value(d, 'file'),
         get_value(d, 'project'))
@@ -207,39 +231,49 @@ def parse_import(d):
 
 
 def parse_module_id(d):
+    """ Module ids are shared between declarations, so they must not be modified """
     if d is None:
         return None
-    return symbols.Module(
-        d['name'],
+    loc = d.get('location')
+    return symbols.interned['modules'].get((d['name'], location_key(loc) if loc else None), lambda: symbols.Module(
+        symbols.intern_string(d['name']),
         [], [], {},
-        parse_location(d.get('location')))
+        parse_location(loc)))
+
+
+lazy_declaration_parsers = {
+    'docs': crlf2lf,
+    'imported': lambda imps: [parse_import(i) for i in imps],
+    'imported_modules': lambda imps: [i['name'] for i in imps],
+    'defined': parse_module_id}
 
 
 def parse_declaration(decl):
+    """
+    Parse declaration, docs, imports and defining module are parsed lazily on first access
+    """
     try:
         what = decl['decl']['what']
-        docs = crlf2lf(decl.get('docs'))
         name = decl['name']
         pos = parse_position(decl.get('pos'))
-        imported = []
-        if 'imported' in decl and decl['imported']:
-            imported = [parse_import(d) for d in decl['imported']]
-        defined = None
-        if 'defined' in decl and decl['defined']:
-            defined = parse_module_id(decl['defined'])
 
         if what == 'function':
-            return symbols.Function(name, decl['decl'].get('type'), docs, imported, defined, pos)
+            result = symbols.Function(name, decl['decl'].get('type'), None, [], None, pos)
         elif what == 'type':
-            return symbols.Type(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), docs, imported, defined, pos)
+            result = symbols.Type(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), None, [], None, pos)
         elif what == 'newtype':
-            return symbols.Newtype(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), docs, imported, defined, pos)
+            result = symbols.Newtype(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), None, [], None, pos)
         elif what == 'data':
-            return symbols.Data(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), docs, imported, defined, pos)
+            result = symbols.Data(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), None, [], None, pos)
         elif what == 'class':
-            return symbols.Class(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), docs, imported, defined, pos)
+            result = symbols.Class(name, decl['decl']['info'].get('ctx'), decl['decl']['info'].get('args', []), decl['decl']['info'].get('def'), None, [], None, pos)
         else:
             return None
+
+        lazy_fields = dict((f, decl[f]) for f in ['docs', 'imported', 'defined'] if decl.get(f))
+        if lazy_fields:
+            result.set_lazy(lazy_declaration_parsers, **lazy_fields)
+        return result
     except Exception as e:
         log('Error pasring declaration: {0}'.format(e), log_error)
         return None
@@ -406,8 +440,15 @@ def connect_function(fn):
     return wrapped
 
 
-def hsdev_command(async = False, timeout = None, is_list = False):
+def hsdev_command(async = False, timeout = None, is_list = False, cached = False, invalidates = False):
+    """
+    cached — results of command are stored in client's cache
+    invalidates — command changes hsdev database, so client's cache is dropped when it finishes
+    is_list — result is list, which hsdev sends by parts, each part is parsed as soon as it arrives
+    and passed to 'on_result_part'; call with 'stream = True' to get parts via HsDevStream
+    """
     def wrap_function(fn):
+        @wraps(fn)
         def wrapped(self, *args, **kwargs):
             wait_flag = kwargs.pop('wait', not async)
             timeout_arg = kwargs.pop('timeout', timeout)
@@ -415,50 +456,167 @@ def hsdev_command(async = False, timeout = None, is_list = False):
             on_not = kwargs.pop('on_notify', None)
             on_err = kwargs.pop('on_error', None)
             on_res_part = kwargs.pop('on_result_part', None)
-            split_res = kwargs.pop('split_result', on_res_part is not None)
+            split_res = kwargs.pop('split_result', True)
+            on_cancel_ = kwargs.pop('on_cancel', None)
+            supersede_ = kwargs.pop('supersede', None)
+            id_ = kwargs.pop('id', None)
+            future_ = HsDevFuture() if kwargs.pop('future', False) else None
+            stream_ = HsDevStream(timeout_arg) if kwargs.pop('stream', False) and is_list else None
 
             (name_, opts_, on_result_) = fn(self, *args, **kwargs)
+            on_result_ = timed_parse(name_, on_result_)
+
+            if future_:
+                id_ = id_ or self.next_id()
+                future_.command = name_
+                future_.id = id_
+                future_.client = self
+                wait_flag = False
+
+            if stream_:
+                id_ = id_ or self.next_id()
+                stream_.command = name_
+                stream_.id = id_
+                stream_.client = self
+                wait_flag = False
+
+            cache_key = HsDevCache.key(name_, opts_) if cached and self.cache else None
+            generation_ = [None]  # cache generation at send time, result is not cached if cache was invalidated since
+
+            def on_error(e, ds):
+                if invalidates and self.cache:
+                    self.cache.invalidate()
+                if future_:
+                    future_.set_error(e, ds)
+                if stream_:
+                    stream_.finish((e, ds))
+                if on_err:
+                    on_err(e, ds)
+
+            def on_cancel():
+                # Server still runs cancelled command, so it may change database
+                if invalidates and self.cache:
+                    self.cache.invalidate()
+                if future_:
+                    future_.set_error('cancelled', {})
+                if stream_:
+                    stream_.finish(('cancelled', {}))
+                if on_cancel_:
+                    on_cancel_()
+
+            def call_(on_response, on_notify, always_respond = False):
+                if cache_key:
+                    generation_[0] = self.cache.generation
+                if invalidates and self.cache:
+                    self.cache.invalidate()
+                r = self.call(
+                    name_,
+                    opts_,
+                    on_response = on_response if (always_respond or on_resp or future_ or cache_key or invalidates) else None,
+                    on_notify = on_notify,
+                    on_error = on_error if (on_err or future_ or stream_ or invalidates) else None,
+                    on_cancel = on_cancel if (on_cancel_ or future_ or stream_ or invalidates) else None,
+                    wait = wait_flag,
+                    timeout = timeout_arg,
+                    id = id_,
+                    supersede = supersede_)
+                if future_:
+                    if not r:
+                        future_.set_error('call failed', {})
+                    return future_
+                if stream_:
+                    if not r:
+                        stream_.finish(('call failed', {}))
+                    return stream_
+                return r
 
             if is_list and split_res:
                 result = []
+                raw_parts = [] if cache_key else None
+                raw_size = [0]
+
+                def on_part(part):
+                    for rp in on_result_([part]) or []:
+                        result.append(rp)
+                        if stream_:
+                            stream_.put(rp)
+                        call_callback(on_res_part, rp)
 
                 def on_notify(n):
                     if 'result-part' in n:
-                        rp = on_result_([n['result-part']])[0]
-                        call_callback(on_res_part, rp)
-                        result.append(rp)
+                        if raw_parts is not None:
+                            raw_parts.append(n['result-part'])
+                            raw_size[0] = raw_size[0] + (self.response_size or 0)
+                        on_part(n['result-part'])
                     else:
                         call_callback(on_not, n)
 
                 def on_response(r):
-                    on_resp(result)
-
-                opts_.update({'split-result': None})  # FIXME: Is this option still used?
-                r = self.call(
-                    name_,
-                    opts_,
-                    on_response = on_response if on_resp else None,
-                    on_notify = on_notify,
-                    on_error = on_err,
-                    wait = wait_flag,
-                    timeout = timeout_arg)
+                    # hsdev may ignore 'split-result' and send whole list in response
+                    if r:
+                        if raw_parts is not None:
+                            raw_parts.extend(r)
+                            raw_size[0] = raw_size[0] + (self.response_size or 0)
+                        for part in r:
+                            on_part(part)
+                    if cache_key:
+                        self.cache.put(cache_key, raw_parts, raw_size[0], generation = generation_[0])
+                    if invalidates and self.cache:
+                        self.cache.invalidate()
+                    if future_:
+                        future_.set_result(result)
+                    if stream_:
+                        stream_.finish()
+                    if on_resp:
+                        on_resp(result)
+
+                if cache_key:
+                    (found, cached_r) = self.cache.get(cache_key)
+                    if found:
+                        for part in cached_r or []:
+                            on_part(part)
+                        if future_:
+                            future_.set_result(result)
+                        if stream_:
+                            stream_.finish()
+                        call_callback(on_resp, result)
+                        return future_ or stream_ or (result if wait_flag else True)
+
+                opts_.update({'split-result': None})
+                r = call_(on_response, on_notify, always_respond = True)
                 if wait_flag:
-                    return result
+                    return result if r is not None else None
                 return r
 
             else:
+                parsed = []  # result, parsed once in on_response, wait returns it
+
                 def on_response(r):
-                    on_resp(on_result_(r))
-                r = self.call(
-                    name_,
-                    opts_,
-                    on_response = on_response if on_resp else None,
-                    on_notify = on_not,
-                    on_error = on_err,
-                    wait = wait_flag,
-                    timeout = timeout_arg)
+                    if cache_key:
+                        self.cache.put(cache_key, r, self.response_size, generation = generation_[0])
+                    if invalidates and self.cache:
+                        self.cache.invalidate()
+                    result = on_result_(r)
+                    parsed.append(result)
+                    if future_:
+                        future_.set_result(result)
+                    if on_resp:
+                        on_resp(result)
+
+                if cache_key:
+                    (found, cached_r) = self.cache.get(cache_key)
+                    if found:
+                        result = on_result_(cached_r)
+                        if future_:
+                            future_.set_result(result)
+                            call_callback(on_resp, result)
+                            return future_
+                        call_callback(on_resp, result)
+                        return result if wait_flag else True
+
+                r = call_(on_response, on_not)
                 if wait_flag:
-                    return on_result_(r)
+                    return parsed[0] if parsed else on_result_(r)
                 return r
         return wrapped
     return wrap_function
@@ -468,6 +626,10 @@ def command(fn):
     return hsdev_command(async = False, timeout = 1)(fn)
 
 
+def cached_command(fn):
+    return hsdev_command(async = False, timeout = 1, cached = True)(fn)
+
+
 def async_command(fn):
     return hsdev_command(async = True)(fn)
 
@@ -476,12 +638,24 @@ def list_command(fn):
     return hsdev_command(async = False, timeout = 1, is_list = True)(fn)
 
 
+def cached_list_command(fn):
+    return hsdev_command(async = False, timeout = 1, is_list = True, cached = True)(fn)
+
+
 def async_list_command(fn):
     return hsdev_command(async = True, is_list = True)(fn)
 
 
-def cmd(name_, opts_ = {}, on_result = lambda r: r):
-    return (name_, opts_, on_result)
+def update_command(fn):
+    return hsdev_command(async = True, invalidates = True)(fn)
+
+
+def update_list_command(fn):
+    return hsdev_command(async = True, is_list = True, invalidates = True)(fn)
+
+
+def cmd(name_, opts_ = None, on_result = lambda r: r):
+    return (name_, opts_ if opts_ is not None else {}, on_result)
 
 
 def call_callback(fn, *args, **kwargs):
@@ -495,27 +669,359 @@ def call_callback(fn, *args, **kwargs):
         log("callback '{0}' throws exception: {1}".format(name or '<unnamed>', e))
 
 
+class HsDevFuture(object):
+    """
+    Result of hsdev command, which will be available later
+    Returned by command called with 'future = True', see HsDev.batch
+    """
+    def __init__(self, command = None):
+        self.command = command
+        self.id = None
+        self.client = None
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, r):
+        self.value = r
+        self.event.set()
+
+    def set_error(self, e, ds):
+        self.error = (e, ds)
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        if self.client and self.id is not None:
+            return self.client.cancel(self.id)
+        return False
+
+    def failed(self):
+        return self.error is not None
+
+    def wait(self, timeout = None):
+        return self.event.wait(timeout)
+
+    def result(self, timeout = None):
+        self.wait(timeout)
+        return self.value
+
+
+class HsDevStream(object):
+    """
+    Parsed parts of list command result, available as soon as they arrive
+    Returned by list command called with 'stream = True', iterate over it to get parts
+    Iteration stops when command finishes, fails or no part arrives in timeout
+    """
+    def __init__(self, timeout = None):
+        self.command = None
+        self.id = None
+        self.client = None
+        self.timeout = timeout
+        self.parts = queue.Queue()
+        self.error = None
+
+    def put(self, part):
+        self.parts.put((True, part))
+
+    def finish(self, error = None):
+        self.error = error
+        self.parts.put((False, None))
+
+    def cancel(self):
+        if self.client and self.id is not None:
+            return self.client.cancel(self.id)
+        return False
+
+    def failed(self):
+        return self.error is not None
+
+    def __iter__(self):
+        while True:
+            try:
+                (more, part) = self.parts.get(True, self.timeout)
+            except queue.Empty:
+                self.error = ('timeout', {})
+                self.cancel()
+                return
+            if not more:
+                return
+            yield part
+
+
 def format_error_details(ds):
     return ', '.join(['{}: {}'.format(k, v) for k, v in ds.items()])
 
 
+class HsDevMetrics(object):
+    """
+    Per-command statistics of hsdev client: wall-clock latency histogram,
+    request and response sizes, time of JSON decoding and time of parsing results
+    """
+    latency_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0]  # upper bounds, seconds
+
+    def __init__(self):
+        self.commands = LockedObject({})
+
+    def command_metrics(self, cs, name):
+        if name not in cs:
+            cs[name] = {
+                'calls': 0,
+                'responses': 0,
+                'errors': 0,
+                'cancelled': 0,
+                'latency': 0.0,
+                'max_latency': 0.0,
+                'histogram': [0] * (len(HsDevMetrics.latency_buckets) + 1),
+                'request_bytes': 0,
+                'response_bytes': 0,
+                'max_response_bytes': 0,
+                'decode_time': 0.0,
+                'parse_time': 0.0}
+        return cs[name]
+
+    def on_request(self, name, size):
+        with self.commands as cs:
+            m = self.command_metrics(cs, name)
+            m['calls'] = m['calls'] + 1
+            m['request_bytes'] = m['request_bytes'] + size
+
+    def on_message(self, name, size, decode_time):
+        """ Any received message: notification or response """
+        with self.commands as cs:
+            m = self.command_metrics(cs, name)
+            m['response_bytes'] = m['response_bytes'] + size
+            m['max_response_bytes'] = max(m['max_response_bytes'], size)
+            m['decode_time'] = m['decode_time'] + decode_time
+
+    def on_finish(self, name, latency, result = 'responses'):
+        """ Response, error or cancellation of request """
+        with self.commands as cs:
+            m = self.command_metrics(cs, name)
+            m[result] = m[result] + 1
+            if latency is not None:
+                m['latency'] = m['latency'] + latency
+                m['max_latency'] = max(m['max_latency'], latency)
+                bucket = len([b for b in HsDevMetrics.latency_buckets if latency > b])
+                m['histogram'][bucket] = m['histogram'][bucket] + 1
+
+    def on_parse(self, name, parse_time):
+        with self.commands as cs:
+            m = self.command_metrics(cs, name)
+            m['parse_time'] = m['parse_time'] + parse_time
+
+    def stats(self):
+        with self.commands as cs:
+            return json.loads(json.dumps(cs))
+
+    def clear(self):
+        with self.commands as cs:
+            cs.clear()
+
+
+metrics = HsDevMetrics()  # metrics of all hsdev clients
+
+
+class HsDevLane(object):
+    """
+    Priority class of client requests: queue depth (requests waiting for response) and wait time
+    Each lane has its own connection, so long scans don't delay interactive queries
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.max_pending = 0
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def on_start(self):
+        with self.lock:
+            self.pending = self.pending + 1
+            self.max_pending = max(self.max_pending, self.pending)
+            self.requests = self.requests + 1
+
+    def on_finish(self, wait):
+        with self.lock:
+            self.pending = max(0, self.pending - 1)
+            if wait is not None:
+                self.total_wait = self.total_wait + wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def is_busy(self):
+        with self.lock:
+            return self.pending > 0
+
+    def stats(self):
+        with self.lock:
+            finished = self.requests - self.pending
+            return {
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'requests': self.requests,
+                'average_wait': self.total_wait / finished if finished else 0.0,
+                'max_wait': self.max_wait}
+
+
+stats_sources = LockedObject({})  # name -> function, returning stats
+
+
+def register_stats(name, fn):
+    """ Register source of statistics, shown by sublime_haskell_show_hsdev_stats """
+    with stats_sources as ss:
+        ss[name] = fn
+
+
+inspected_listeners = LockedObject([])  # functions, called with list of rescanned files or None if anything could change
+
+
+def add_inspected_listener(fn):
+    """ Register function, called when agent finishes scanning sources """
+    with inspected_listeners as ls:
+        ls.append(fn)
+
+
+def notify_inspected(files = None):
+    with inspected_listeners as ls:
+        listeners = ls[:]
+    for fn in listeners:
+        try:
+            fn(files)
+        except Exception as e:
+            log('inspected listener failed: {0}'.format(e), log_error)
+
+
+def content_digest(contents, opts = None):
+    """ Hash of scan or check inputs: contents (bytes or text) and options """
+    h = content_hash()
+    h.update(contents.encode('utf-8') if isinstance(contents, type(u'')) else contents)
+    h.update(json.dumps(opts, sort_keys = True).encode('utf-8'))
+    return h.digest()
+
+
+def file_mtime(filename):
+    """ Modification time of file, None if file can't be accessed """
+    try:
+        return os.path.getmtime(filename)
+    except (IOError, OSError):
+        return None
+
+
+def file_digest(filename, opts = None):
+    """ Hash of file contents and options, None if file can't be read """
+    try:
+        with open(filename, 'rb') as f:
+            return content_digest(f.read(), opts)
+    except (IOError, OSError):
+        return None
+
+
+class ContentHashes(object):
+    """
+    Hashes of inputs of last successful scans and checks per kind ('scan', 'contents', 'check') and file,
+    so that repeated ones with same inputs are skipped
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes = {}  # (kind, filename) ⇒ digest
+        self.counters = {}  # kind ⇒ (checked, skipped)
+
+    def unchanged(self, kind, filename, digest):
+        """ Whether inputs are same as of last successful run, counted for stats """
+        with self.lock:
+            same = digest is not None and self.hashes.get((kind, filename)) == digest
+            (checked, skipped) = self.counters.get(kind, (0, 0))
+            self.counters[kind] = (checked + 1, skipped + 1 if same else skipped)
+            return same
+
+    def update(self, kind, filename, digest):
+        with self.lock:
+            if digest is None:
+                self.hashes.pop((kind, filename), None)
+            else:
+                self.hashes[(kind, filename)] = digest
+
+    def drop(self, kind, files = None):
+        """ Forget hashes of kind for files or for all files """
+        with self.lock:
+            if files is None:
+                for k in [k for k in self.hashes if k[0] == kind]:
+                    del self.hashes[k]
+            else:
+                for f in files:
+                    self.hashes.pop((kind, f), None)
+
+    def clear(self):
+        with self.lock:
+            self.hashes.clear()
+
+    def stats(self):
+        with self.lock:
+            result = dict((kind, {
+                'checked': checked,
+                'skipped': skipped,
+                'skip_rate': float(skipped) / checked if checked else 0.0}) for kind, (checked, skipped) in self.counters.items())
+            result['entries'] = len(self.hashes)
+            return result
+
+
+content_hashes = ContentHashes()  # inputs of last scans and checks
+register_stats('skipped scans', content_hashes.stats)
+
+
+def collect_stats():
+    with stats_sources as ss:
+        sources = list(ss.items())
+    result = {'commands': metrics.stats()}
+    for name, fn in sources:
+        try:
+            result[name] = fn()
+        except Exception as e:
+            result[name] = {'error': str(e)}
+    return result
+
+
+def timed_parse(name, on_result):
+    """ Wrap result parser to measure its time """
+    def parse(r):
+        start = time.time()
+        try:
+            return on_result(r)
+        finally:
+            metrics.on_parse(name, time.time() - start)
+    return parse
+
+
 class HsDevCallbacks(object):
-    def __init__(self, id, command, on_response = None, on_notify = None, on_error = None):
+    def __init__(self, id, command, on_response = None, on_notify = None, on_error = None, on_cancel = None, name = None, lane = None):
         self.id = id
         self.command = command
-        self.start_time = time.clock()
+        self.name = name or command
+        self.lane = lane
+        self.start_time = time.time()
         self.on_response = on_response
         self.on_notify = on_notify
         self.on_error = on_error
+        self.on_cancel = on_cancel
 
     def time(self):
-        return time.clock() - self.start_time if self.start_time is not None else None
+        return time.time() - self.start_time if self.start_time is not None else None
 
     def log_time(self):
         log('{0}: {1} seconds'.format(self.command, self.time()), log_trace)
 
+    def finish_lane(self, cancelled = False):
+        if self.lane is not None:
+            self.lane.on_finish(None if cancelled else self.time())
+            self.lane = None
+
     def call_response(self, r):
         self.log_time()
+        metrics.on_finish(self.name, self.time())
+        self.finish_lane()
         call_callback(self.on_response, r)
 
     def call_notify(self, n):
@@ -523,15 +1029,198 @@ class HsDevCallbacks(object):
 
     def call_error(self, e, ds):
         self.log_time()
+        metrics.on_finish(self.name, self.time(), 'errors')
+        self.finish_lane()
         log('{0} returns error: {1}, {2}'.format(self.command, e, format_error_details(ds)), log_error)
         call_callback(self.on_error, e, ds)
 
+    def call_cancel(self):
+        log('{0}: cancelled'.format(self.command), log_trace)
+        metrics.on_finish(self.name, None, 'cancelled')
+        self.finish_lane(cancelled = True)
+        call_callback(self.on_cancel)
+
+
+class HsDevReceiveBuffer(object):
+    """
+    Receive buffer for newline-delimited hsdev messages
+    Only newly received bytes are scanned for newline and each complete frame is decoded once
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def feed(self, chunk):
+        self.buffer.extend(chunk)
+
+    def frames(self):
+        """ Pop all complete frames from buffer """
+        result = []
+        start = 0
+        end = self.buffer.find(b'\n', self.scanned)
+        while end != -1:
+            result.append(self.buffer[start:end].decode('utf-8'))
+            start = end + 1
+            end = self.buffer.find(b'\n', start)
+        if start:
+            del self.buffer[:start]
+        self.scanned = len(self.buffer)
+        return result
+
+    def clear(self):
+        self.buffer = bytearray()
+        self.scanned = 0
+
+
+class HsDevCache(object):
+    """
+    LRU cache of results of read-only hsdev commands, keyed by command name and arguments
+    Size is measured as size of raw responses, all entries are dropped when hsdev database changes
+    Each invalidation starts new generation, results of requests sent in previous generation are not stored
+    """
+    def __init__(self, max_size = 64 * 1024 * 1024, max_entries = 1024):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.entries = LockedObject(OrderedDict())  # key ⇒ (result, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    @staticmethod
+    def key(command, opts):
+        return json.dumps([command, opts], sort_keys = True, separators = (',', ':'))
+
+    def get(self, key):
+        """ Returns pair (found, result) """
+        with self.entries as es:
+            if key in es:
+                self.hits = self.hits + 1
+                es.move_to_end(key)
+                return (True, es[key][0])
+            self.misses = self.misses + 1
+            return (False, None)
+
+    def put(self, key, result, size = None, generation = None):
+        """ Store result, unless cache was invalidated since generation, when request was sent """
+        size = size or 0
+        if size > self.max_size:
+            return
+        with self.entries as es:
+            if generation is not None and generation != self.generation:
+                return
+            if key in es:
+                self.size = self.size - es.pop(key)[1]
+            es[key] = (result, size)
+            self.size = self.size + size
+            while es and (self.size > self.max_size or len(es) > self.max_entries):
+                (_, (_, evicted_size)) = es.popitem(last = False)
+                self.size = self.size - evicted_size
+                self.evictions = self.evictions + 1
+
+    def invalidate(self):
+        with self.entries as es:
+            self.generation = self.generation + 1
+            if es:
+                es.clear()
+                self.invalidations = self.invalidations + 1
+            self.size = 0
+
+    def stats(self):
+        with self.entries as es:
+            return {
+                'entries': len(es),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+
+class TcpTransport(object):
+    """
+    Connection to hsdev server via TCP on localhost
+    """
+    def __init__(self, port = 4567, host = '127.0.0.1'):
+        self.port = port
+        self.host = host
+
+    def __str__(self):
+        return '{0}:{1}'.format(self.host, self.port)
+
+    def prepare(self):
+        pass
+
+    def server_args(self):
+        return ['--port', str(self.port)]
+
+    def create_socket(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Message and its terminating newline are sent separately, don't let Nagle delay the latter
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return s
+
+    def address(self):
+        return (self.host, self.port)
+
+
+class UnixTransport(object):
+    """
+    Connection to hsdev server via unix domain socket
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def prepare(self):
+        # Remove socket file left by previous server
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def server_args(self):
+        return ['--unix', self.path]
+
+    def create_socket(self):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def address(self):
+        return self.path
+
+    @staticmethod
+    def supported():
+        return hasattr(socket, 'AF_UNIX')
+
+
+def make_transport():
+    """
+    Create transport from 'hsdev_connection' setting: 'tcp' (default) or 'unix'
+    """
+    connection = get_setting_async('hsdev_connection', 'tcp')
+    if connection == 'unix':
+        if UnixTransport.supported():
+            path = get_setting_async('hsdev_socket_path') or os.path.join(sublime_haskell_cache_path(), 'hsdev', 'hsdev.sock')
+            return UnixTransport(path)
+        log('unix domain sockets are not supported on this platform, using tcp', log_warning)
+    elif connection != 'tcp':
+        log('unknown hsdev_connection: {0}, using tcp'.format(connection), log_warning)
+    return TcpTransport(get_setting_async('hsdev_port', 4567))
+
 
 # hsdev client
 # see for functions with command decorator for hsdev api
 class HsDev(object):
-    def __init__(self, port = 4567):
-        self.port = port
+    recv_size = 65536  # bytes to receive per recv call
+
+    def __init__(self, port = 4567, cache = None, transport = None, lane = None):
+        self.transport = transport or TcpTransport(port)
+        self.lane = lane if isinstance(lane, HsDevLane) else HsDevLane(lane or 'default')
+        self.cache = cache if cache is not None else HsDevCache()
+        self.response_size = None  # size of response being processed, set in listen
+        self.decode_time = None  # time of decoding response being processed
         self.connecting = threading.Event()
         self.connected = threading.Event()
         self.socket = None
@@ -539,11 +1228,12 @@ class HsDev(object):
         self.hsdev_address = None
         self.autoconnect = True
         self.map = LockedObject({})
+        self.superseding = LockedObject({})  # supersede key ⇒ id of latest request
         self.id = 1
 
         self.connect_fun = None
 
-        self.part = ''
+        self.received = HsDevReceiveBuffer()
 
         self.on_connected = None
         self.on_disconnected = None
@@ -567,10 +1257,12 @@ class HsDev(object):
 
     # Create server process
     @staticmethod
-    def create_server(port = 4567, cache = None, log_file = None, log_config = None):
+    def create_server(transport = None, cache = None, log_file = None, log_config = None):
+        transport = transport or TcpTransport()
+        transport.prepare()
         cmd = concat_args([
             (True, ["hsdev", "run"]),
-            (port, ["--port", str(port)]),
+            (True, transport.server_args()),
             (cache, ["--cache", cache]),
             (log_file, ["--log", log_file]),
             (log_config, ["--log-config", log_config])])
@@ -582,9 +1274,12 @@ class HsDev(object):
             return None
         while True:
             output = crlf2lf(decode_bytes(p.stdout.readline()))
-            m = re.match(r'^.*?hsdev> Server started at port (?P<port>\d+)$', output)
+            if not output and p.poll() is not None:
+                log('hsdev server exited with code {0}'.format(p.returncode), log_error)
+                return None
+            m = re.match(r'^.*?hsdev> Server started at (?P<address>.*)$', output)
             if m:
-                log('hsdev server started at port {0}'.format(m.group('port')))
+                log('hsdev server started at {0}'.format(m.group('address')))
                 p.stdout.close()
                 p.stderr.close()
                 return p
@@ -594,14 +1289,13 @@ class HsDev(object):
     @connect_function
     @reconnect_function
     def connect(self, tries = 10, delay = 1.0):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
         for n in range(0, tries):
             try:
-                log('connecting to hsdev server ({0})...'.format(n), log_info)
-                self.socket.connect(('127.0.0.1', self.port))
+                log('connecting to hsdev server at {0} ({1})...'.format(self.transport, n), log_info)
+                self.socket = self.transport.create_socket()
+                self.socket.connect(self.transport.address())
                 self.hsdev_socket = self.socket
-                self.hsdev_address = '127.0.0.1'
+                self.hsdev_address = str(self.transport)
                 self.set_connected()
                 self.listener = threading.Thread(target = self.listen)
                 self.listener.start()
@@ -610,6 +1304,7 @@ class HsDev(object):
                 return True
             except Exception:
                 log('failed to connect to hsdev server ({0})'.format(n), log_warning)
+                self.socket.close()
                 time.sleep(delay)
 
         return False
@@ -659,9 +1354,39 @@ class HsDev(object):
         else:
             log('HsDev.set_connected called while not in connecting state', log_debug)
 
-    def on_receive(self, id, command, on_response = None, on_notify = None, on_error = None):
+    def on_receive(self, id, command, on_response = None, on_notify = None, on_error = None, on_cancel = None, name = None):
+        self.lane.on_start()
+        with self.map as m:
+            m[id] = HsDevCallbacks(id, command, on_response, on_notify, on_error, on_cancel, name, self.lane)
+
+    def next_id(self):
+        with self.map:
+            id = str(self.id)
+            self.id = self.id + 1
+            return id
+
+    def cancel(self, id):
+        """
+        Cancel request: its callbacks are dropped and its response will be ignored
+        hsdev protocol has no command to cancel request, so server still processes it
+        """
         with self.map as m:
-            m[id] = HsDevCallbacks(id, command, on_response, on_notify, on_error)
+            callbacks = m.pop(id, None)
+        if callbacks:
+            callbacks.call_cancel()
+            return True
+        return False
+
+    def supersede(self, key, id):
+        """
+        Set request id as the latest one for key, cancelling previous request for same key
+        For example, only the latest 'check' for some file matters
+        """
+        with self.superseding as ids:
+            old_id = ids.get(key)
+            ids[key] = id
+        if old_id is not None and old_id != id:
+            self.cancel(old_id)
 
     def verify_connected(self):
         if self.is_connected():
@@ -676,20 +1401,23 @@ class HsDev(object):
         self.close()
         log('{0}: connection to hsdev lost: {1}'.format(fn, e), log_error)
         call_callback(self.on_disconnected, name = 'HsDev.on_disconnected')
+        self.cache.invalidate()
 
         # send error to callbacks
         with self.map as m:
             for on_msg in m.values():
-                on_msg.on_error('connection lost')
+                on_msg.call_error('connection lost', {})
             m.clear()
+        with self.superseding as ids:
+            ids.clear()
 
         self.id = 1
-        self.part = ''
+        self.received.clear()
 
         if self.autoconnect:
             self.reconnect()
 
-    def call(self, command, opts = {}, on_response = None, on_notify = None, on_error = None, wait = False, timeout = None, id = None):
+    def call(self, command, opts = {}, on_response = None, on_notify = None, on_error = None, on_cancel = None, wait = False, timeout = None, id = None, supersede = None):
         # log
         args_cmd = 'hsdev {0}'.format(command)
         call_cmd = 'hsdev {0} with {1}'.format(command, opts)
@@ -713,20 +1441,27 @@ class HsDev(object):
                 if wait_receive:
                     wait_receive.set()
 
-            if wait or on_response or on_notify or on_error:
+            def on_cancel_():
+                call_callback(on_cancel)
+                if wait_receive:
+                    wait_receive.set()
+
+            if wait or on_response or on_notify or on_error or on_cancel or supersede:
                 if id is None:
-                    id = str(self.id)
-                    self.id = self.id + 1
-                self.on_receive(id, args_cmd, on_response_, on_notify, on_error_)
+                    id = self.next_id()
+                self.on_receive(id, args_cmd, on_response_, on_notify, on_error_, on_cancel_, command)
+                if supersede is not None:
+                    self.supersede(supersede, id)
 
             opts.update({'no-file': True})
             opts.update({'id': id, 'command': command})
-            msg = json.dumps(opts, separators = (',', ':'))
+            msg = json.dumps(opts, separators = (',', ':')).encode('utf-8')
+            metrics.on_request(command, len(msg) + 1)
 
             # Seems, that first sendall doesn't throw error on closed socket
             # So we just call it twice
             # It's hackish, but I haven't found easy solution
-            self.hsdev_socket.sendall(msg.encode('utf-8'))
+            self.hsdev_socket.sendall(msg)
             self.hsdev_socket.sendall('\n'.encode('utf-8'))
             log(call_cmd, log_trace)
 
@@ -743,34 +1478,58 @@ class HsDev(object):
     def listen(self):
         while self.verify_connected():
             try:
-                resp = json.loads(self.get_response())
-                if 'id' in resp:
-                    callbacks = None
-                    with self.map as m:
-                        if resp['id'] in m:
-                            callbacks = m[resp['id']]
-                    if callbacks:
-                        if 'notify' in resp:
-                            callbacks.call_notify(resp['notify'])
-                        if 'error' in resp:
-                            err = resp.pop("error")
-                            callbacks.call_error(err, resp)
-                            with self.map as m:
-                                m.pop(resp['id'])
-                        if 'result' in resp:
-                            callbacks.call_response(resp['result'])
-                            with self.map as m:
-                                m.pop(resp['id'])
+                for frame in self.get_responses():
+                    self.response_size = len(frame)
+                    start = time.time()
+                    resp = json.loads(frame)
+                    self.decode_time = time.time() - start
+                    self.process_response(resp)
             except Exception as e:
                 self.connection_lost('listen', e)
                 return
 
-    def get_response(self):
-        while '\n' not in self.part:
-            self.part = self.part + self.socket.recv(65536).decode('utf-8')
-        (r, _, post) = self.part.partition('\n')
-        self.part = post
-        return r
+    def process_response(self, resp):
+        if 'id' in resp:
+            # Final response removes callbacks before dispatching, so that request, cancelled or superseded
+            # by other thread meanwhile, gets either response or cancel, but not both
+            final = 'error' in resp or 'result' in resp
+            with self.map as m:
+                callbacks = m.pop(resp['id'], None) if final else m.get(resp['id'])
+            if callbacks:
+                metrics.on_message(callbacks.name, self.response_size or 0, self.decode_time or 0.0)
+                if 'notify' in resp:
+                    callbacks.call_notify(resp['notify'])
+                if 'error' in resp:
+                    err = resp.pop("error")
+                    callbacks.call_error(err, resp)
+                elif 'result' in resp:
+                    callbacks.call_response(resp['result'])
+
+    def get_responses(self):
+        """ Receive until at least one complete response, returns all complete responses """
+        frames = self.received.frames()
+        while not frames:
+            chunk = self.socket.recv(HsDev.recv_size)
+            if not chunk:
+                raise IOError('connection closed by hsdev')
+            self.received.feed(chunk)
+            frames = self.received.frames()
+        return frames
+
+    def batch(self, futures, timeout = None):
+        """
+        Wait for several commands sent with 'future = True'
+        Commands are already sent, so we wait for the slowest reply only
+        Returns list of results, None for failed or timed out commands
+            (whois, lookup) = client.batch([client.whois(n, f, future = True), client.lookup(n, f, future = True)])
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        for f in futures:
+            if deadline is None:
+                f.wait()
+            else:
+                f.wait(max(0, deadline - time.time()))
+        return [f.value for f in futures]
 
     # Commands
 
@@ -783,7 +1542,7 @@ class HsDev(object):
     def ping(self):
         return cmd('ping', {}, lambda r: r and ('message' in r) and (r['message'] == 'pong'))
 
-    @async_command
+    @update_command
     def scan(self, cabal = False, sandboxes = [], projects = [], files = [], paths = [], ghc = [], contents = {}, docs = False, infer = False):
         return cmd('scan', {
             'projects': projects,
@@ -796,21 +1555,21 @@ class HsDev(object):
             'docs': docs,
             'infer': infer})
 
-    @async_command
+    @update_command
     def docs(self, projects = [], files = [], modules = []):
         return cmd('docs', {
             'projects': projects,
             'files': files,
             'modules': modules})
 
-    @async_command
+    @update_command
     def infer(self, projects = [], files = [], modules = []):
         return cmd('infer', {
             'projects': projects,
             'files': files,
             'modules': modules})
 
-    @async_list_command
+    @update_list_command
     def remove(self, cabal = False, sandboxes = [], projects = [], files = [], packages = []):
         return cmd('remove', {
             'projects': projects,
@@ -819,11 +1578,11 @@ class HsDev(object):
             'files': files,
             'packages': packages})
 
-    @command
+    @hsdev_command(async = False, timeout = 1, invalidates = True)
     def remove_all(self):
         return cmd('remove-all', {})
 
-    @list_command
+    @cached_list_command
     def list_modules(self, project = None, file = None, module = None, deps = None, sandbox = None, cabal = False, db = None, package = None, source = False, standalone = False):
         fs = []
         if project:
@@ -886,7 +1645,7 @@ class HsDev(object):
 
         return cmd('symbol', {'query': q, 'filters': fs, 'locals': locals}, parse_decls)
 
-    @command
+    @cached_command
     def module(self, input = "", search_type = 'prefix', project = None, file = None, module = None, deps = None, sandbox = None, cabal = False, db = None, package = None, source = False, standalone = False):
         q = {'input': input, 'type': search_type}
 
@@ -926,19 +1685,19 @@ class HsDev(object):
     def sandbox(self, path):
         return cmd('sandbox', {'path': path})
 
-    @list_command
+    @cached_list_command
     def lookup(self, name, file):
         return cmd('lookup', {'name': name, 'file': file}, parse_decls)
 
-    @list_command
+    @cached_list_command
     def whois(self, name, file):
         return cmd('whois', {'name': name, 'file': file}, parse_declarations)
 
-    @list_command
+    @cached_list_command
     def scope_modules(self, file, input = '', search_type = 'prefix'):
         return cmd('scope modules', {'query': {'input': input, 'type': search_type}, 'file': file}, parse_modules_brief)
 
-    @list_command
+    @cached_list_command
     def scope(self, file, input = '', search_type = 'prefix', global_scope = False):
         return cmd('scope', {'query': {'input': input, 'type': search_type}, 'global': global_scope, 'file': file}, parse_declarations)
 
@@ -983,11 +1742,11 @@ class HsDev(object):
             'contents': [{'file': f, 'contents': cts} for f, cts in contents.items()],
             'ghc-opts': ghc})
 
-    @command
+    @cached_command
     def langs(self):
         return cmd('langs')
 
-    @command
+    @cached_command
     def flags(self):
         return cmd('flags')
 
@@ -1040,14 +1799,14 @@ def wait_result(fn, *args, **kwargs):
 
 # hsdev server process with auto-restart
 class HsDevProcess(threading.Thread):
-    def __init__(self, port = 4567, cache = None, log_file = None, log_config = None):
+    def __init__(self, transport = None, cache = None, log_file = None, log_config = None):
         super(HsDevProcess, self).__init__()
         self.process = None
         self.on_start = None
         self.on_exit = None
         self.stop_event = threading.Event()
         self.create_event = threading.Event()
-        self.port = port
+        self.transport = transport or TcpTransport()
         self.cache = cache
         self.log_file = log_file
         self.log_config = log_config
@@ -1057,14 +1816,14 @@ class HsDevProcess(threading.Thread):
             self.create_event.wait()
             self.create_event.clear()
             while not self.stop_event.is_set():
-                self.process = HsDev.create_server(port = self.port, cache = self.cache, log_file = self.log_file, log_config = self.log_config)
+                self.process = HsDev.create_server(transport = self.transport, cache = self.cache, log_file = self.log_file, log_config = self.log_config)
                 if not self.process:
                     log('failed to create hsdev process', log_error)
                     self.stop_event.set()
                 else:
                     call_callback(self.on_start, name = 'HsDevProcess.on_start')
-                self.process.wait()
-                call_callback(self.on_exit, name = 'HsDevProcess.on_exit')
+                    self.process.wait()
+                    call_callback(self.on_exit, name = 'HsDevProcess.on_exit')
             self.stop_event.clear()
 
     def active(self):
@@ -1082,20 +1841,39 @@ class HsDevProcess(threading.Thread):
 
 agent = None  # global hsdev agent
 client = None  # global hsdev agent's hsdev client for command tasks
-client_back = None  # global hsdev agent's hsdev client for background tasks (commonly scanning)
+client_back = None  # global hsdev agent's hsdev client for foreground batches (completions, module info)
+client_scan = None  # global hsdev agent's hsdev client for background tasks (scanning)
 
 
 # Show scan progress in status bar
 class scan_status(object):
+    """
+    Progress of scans, progress of parallel scans is merged into one message
+    """
     def __init__(self, status_message):
         self.status_message = status_message
+        self.statuses = LockedObject(OrderedDict())  # scan ⇒ its progress
 
     def __call__(self, msg):
+        self.update(None, msg)
+
+    def job(self, name):
+        """ Notification callback for one of parallel scans """
+        return lambda msg: self.update(name, msg)
+
+    def update(self, name, msg):
         statuses = []
         for m in msg:
             p = m['progress']
             statuses.append('{0} ({1}/{2})'.format(m['name'], p['current'], p['total']) if p else m['name'])
-        self.status_message.change_message('Inspecting {0}'.format(' / '.join(statuses)))
+        with self.statuses as ss:
+            ss[name] = ' / '.join(statuses)
+            text = ', '.join(st for st in ss.values() if st)
+        self.status_message.change_message('Inspecting {0}'.format(text))
+
+    def done(self, name):
+        with self.statuses as ss:
+            ss.pop(name, None)
 
 
 # Set reinspect event
@@ -1125,7 +1903,7 @@ def use_inspect_modules(fn):
 
 
 def agent_connected():
-    return agent.is_connected()
+    return agent is not None and agent.is_connected()
 
 
 # Return default value if hsdev is not enabled/connected
@@ -1140,26 +1918,107 @@ def use_hsdev(def_val = None):
     return wrap
 
 
+class DirtyQueue(object):
+    """
+    Ordered set of items to rescan, so that item marked many times is scanned once
+    Bursts of changes are coalesced: items are taken only when nothing was marked for debounce seconds,
+    except for urgent ones (saved files), which are taken first and immediately
+    """
+    def __init__(self):
+        self.items = LockedObject(OrderedDict())  # item ⇒ urgent
+        self.last_mark = 0
+        self.marked = 0
+        self.coalesced = 0
+        self.batches = 0
+
+    def mark(self, item, urgent = False):
+        with self.items as items:
+            self.marked += 1
+            if item in items:
+                self.coalesced += 1
+                urgent = urgent or items.pop(item)
+            items[item] = urgent
+            if not urgent:
+                self.last_mark = time.time()
+
+    def take(self, debounce = 0, limit = None):
+        """ Take urgent items and items, that are ready (if debounce passed), at most limit """
+        with self.items as items:
+            ready = time.time() - self.last_mark >= debounce
+            batch = [k for k, urgent in items.items() if urgent]
+            if ready:
+                batch.extend([k for k, urgent in items.items() if not urgent])
+            if limit:
+                batch = batch[:limit]
+            for k in batch:
+                del items[k]
+            if batch:
+                self.batches += 1
+            return batch
+
+    def wait_time(self, debounce = 0):
+        """ Seconds until there will be items to take or None if there are no items """
+        with self.items as items:
+            if not items:
+                return None
+            return max(0, self.last_mark + debounce - time.time())
+
+    def __len__(self):
+        with self.items as items:
+            return len(items)
+
+    def stats(self):
+        return {
+            'pending': len(self),
+            'marked': self.marked,
+            'coalesced': self.coalesced,
+            'batches': self.batches}
+
+
 # hsdev agent
 # holds hsdev server process and two clients: for commands and for background tasks
 # also automatically reinspects files/paths/etc. when they marked as dirty
 class HsDevAgent(threading.Thread):
     sleep_timeout = 60.0  # agent sleeping timeout
+    saved_files_timeout = 60.0  # how long to remember files saved in editor
     min_ver = [0, 2, 0, 0]  # minimal hsdev version
     max_ver = [0, 2, 1, 0]  # maximal hsdev version
 
     def __init__(self):
         super(HsDevAgent, self).__init__()
         self.daemon = True
-        self.cabal_to_load = LockedObject([])
-        self.dirty_files = LockedObject([])
-        self.dirty_paths = LockedObject([])
+        self.cabal_to_load = DirtyQueue()
+        self.dirty_files = DirtyQueue()
+        self.dirty_paths = DirtyQueue()
+        self.transport = make_transport()
         self.hsdev_process = HsDevProcess(
+            transport = self.transport,
             cache = os.path.join(sublime_haskell_cache_path(), 'hsdev'),
             log_file = os.path.join(sublime_haskell_cache_path(), 'hsdev', 'hsdev.log'),
             log_config = get_setting_async('hsdev_log_config'))
-        self.client = HsDev()
-        self.client_back = HsDev()
+        # results cache, shared by clients and dropped when scan finishes
+        self.cache = HsDevCache(max_size = get_setting_async('hsdev_cache_size', 64) * 1024 * 1024)
+        register_stats('cache', self.cache.stats)
+        register_stats('interning', symbols.interning_stats)
+        register_stats('symbol index', symbol_index.index.stats)
+        register_stats('scan queue', lambda: {
+            'files': self.dirty_files.stats(),
+            'paths': self.dirty_paths.stats(),
+            'cabal': self.cabal_to_load.stats()})
+        # Priority lanes: interactive queries, foreground batches and background scans use separate connections
+        self.client = HsDev(cache = self.cache, transport = self.transport, lane = 'interactive')
+        self.client_back = HsDev(cache = self.cache, transport = self.transport, lane = 'foreground')
+        self.client_scan = HsDev(cache = self.cache, transport = self.transport, lane = 'background')
+        # Pool of connections for background scans, independent projects and package dbs are scanned in parallel
+        self.scan_clients = [self.client_scan] + [
+            HsDev(cache = self.cache, transport = self.transport, lane = self.client_scan.lane)
+            for _ in range(max(1, get_setting_async('scan_concurrency', 2)) - 1)]
+        register_stats('lanes', lambda: dict((c.lane.name, c.lane.stats()) for c in [self.client, self.client_back, self.client_scan]))
+        # Watcher of changes made outside of editor, started with first inspection
+        self.watcher = None
+        register_stats('watcher', lambda: self.watcher.stats() if self.watcher else {'mode': None})
+        # Files saved in editor ⇒ (modification time, save time), watcher reports these saves too
+        self.saved_files = LockedObject({})
 
         self.reinspect_event = threading.Event()
 
@@ -1189,22 +2048,26 @@ class HsDevAgent(threading.Thread):
                 log('hsdev process started', log_trace)
                 self.client.connect_async()
                 self.client_back.connect_async()
+                for c in self.scan_clients:
+                    c.connect_async()
 
             def exit_():
                 log('hsdev process exited', log_trace)
                 self.client.close()
                 self.client_back.close()
+                for c in self.scan_clients:
+                    c.close()
 
             def connected_():
                 log('hsdev agent: connected to hsdev', log_trace)
                 self.client.link()
 
-            def back_connected_():
+            def scan_connected_():
                 log('hsdev agent: connected to hsdev', log_trace)
                 self.start_inspect()
 
             self.client.on_connected = connected_
-            self.client_back.on_connected = back_connected_
+            self.client_scan.on_connected = scan_connected_
 
             self.hsdev_process.on_start = start_
             self.hsdev_process.on_exit = exit_
@@ -1215,6 +2078,8 @@ class HsDevAgent(threading.Thread):
     def stop_hsdev(self):
         self.client.close()
         self.client_back.close()
+        for c in self.scan_clients:
+            c.close()
 
     def on_hsdev_enabled(self, key, value):
         if key == 'enable_hsdev':
@@ -1226,6 +2091,16 @@ class HsDevAgent(threading.Thread):
                 self.hsdev_process.stop()
                 self.client.close()
                 self.client_back.close()
+                for c in self.scan_clients:
+                    c.close()
+                self.stop_watcher()
+
+    def on_watch_files_changed(self, key, value):
+        if key == 'watch_files':
+            if value:
+                self.update_watcher()
+            else:
+                self.stop_watcher()
 
     def on_inspect_modules_changed(self, key, value):
         if key == 'inspect_modules':
@@ -1235,6 +2110,7 @@ class HsDevAgent(threading.Thread):
     def run(self):
         subscribe_setting('enable_hsdev', self.on_hsdev_enabled)
         subscribe_setting('inspect_modules', self.on_inspect_modules_changed)
+        subscribe_setting('watch_files', self.on_watch_files_changed)
 
         if get_setting_async('enable_hsdev'):
             self.start_hsdev()
@@ -1243,52 +2119,66 @@ class HsDevAgent(threading.Thread):
             if get_setting_async('enable_hsdev') and not self.client.ping():
                 log('hsdev ping: no pong', log_warning)
 
-            location = self.view.sel()[0].begin()
-            if self.view.match_selector(location, 'source.cs')
-                scan_paths = []
-                with self.dirty_paths as dirty_paths:
-                    scan_paths = dirty_paths[:]
-                    dirty_paths[:] = []
+            debounce = get_setting_async('inspect_debounce', 1.0)
+            batch_size = get_setting_async('inspect_batch_size', 100)
 
-                files_to_reinspect = []
-                with self.dirty_files as dirty_files:
-                    files_to_reinspect = dirty_files[:]
-                    dirty_files[:] = []
+            # Saved files are urgent and are scanned first, big changes are scanned in batches,
+            # so that newly saved files don't wait for them
+            files_to_reinspect = self.dirty_files.take(debounce, batch_size)
+            scan_paths = [] if len(files_to_reinspect) >= batch_size else self.dirty_paths.take(debounce, len(self.scan_clients))
 
-                projects = []
-                files = []
+            # Files, which contents and ghc options are same as when they were scanned last time, are skipped
+            ghc_opts = get_setting_async('ghc_opts')
+            digests = dict((f, file_digest(f, ghc_opts)) for f in files_to_reinspect)
+            files_to_reinspect = [f for f in files_to_reinspect if not content_hashes.unchanged('scan', f, digests[f])]
 
-                if len(files_to_reinspect) > 0:
-                    projects = []
-                    files = []
-                    for f in files_to_reinspect:
-                        d = get_cabal_project_dir_of_file(f)
-                        if d is not None:
-                            projects.append(d)
-                        else:
-                            files.append(f)
+            projects = []
+            files = []
 
-                projects = list(set(projects))
-                files = list(set(files))
-
-                try:
-                    self.inspect(paths = scan_paths, projects = projects, files = files)
-                except Exception as e:
-                    log('HsDevAgent inspect exception: {0}'.format(e))
+            if len(files_to_reinspect) > 0:
+                projects = []
+                files = []
+                for f in files_to_reinspect:
+                    d = get_cabal_project_dir_of_file(f)
+                    if d is not None:
+                        projects.append(d)
+                    else:
+                        files.append(f)
 
-                load_cabal = []
-                with self.cabal_to_load as cabal_to_load:
-                    load_cabal = cabal_to_load[:]
-                    cabal_to_load[:] = []
+            projects = list(set(projects))
+            files = list(set(files))
 
-                for c in load_cabal:
-                    run_async('inspect cabal {0}'.format(c), self.inspect_cabal, c)
+            if files_to_reinspect or scan_paths:
+                self.yield_to_interactive()
 
-                if files_to_reinspect:
-                    if get_setting_async('enable_hdocs'):
-                        self.client_back.docs(files = files_to_reinspect)
-                self.reinspect_event.wait(HsDevAgent.sleep_timeout)
-                self.reinspect_event.clear()
+            try:
+                if self.inspect(paths = scan_paths, projects = projects, files = files, changed = files_to_reinspect):
+                    for f in files_to_reinspect:
+                        content_hashes.update('scan', f, digests[f])
+            except Exception as e:
+                log('HsDevAgent inspect exception: {0}'.format(e))
+
+            if files_to_reinspect:
+                if get_setting_async('enable_hdocs'):
+                    self.client_scan.docs(files = files_to_reinspect)
+
+            # Cabal and sandboxes are rescanned (in parallel) only when there are no urgent files
+            if not files_to_reinspect and not scan_paths:
+                cabals = self.cabal_to_load.take(0, len(self.scan_clients))
+                if cabals:
+                    self.yield_to_interactive()
+                    self.inspect_cabals(cabals)
+
+            waits = [w for w in [q.wait_time(debounce) for q in [self.dirty_files, self.dirty_paths, self.cabal_to_load]] if w is not None]
+            self.reinspect_event.wait(min(waits) if waits else HsDevAgent.sleep_timeout)
+            self.reinspect_event.clear()
+
+    def yield_to_interactive(self):
+        """ Scans yield to interactive queries: wait (bounded) until interactive lane has no pending requests """
+        timeout = get_setting_async('interactive_yield_timeout', 1.0)
+        start = time.time()
+        while self.client.lane.is_busy() and time.time() - start < timeout:
+            time.sleep(0.01)
 
     @dirty
     def force_inspect(self):
@@ -1296,6 +2186,8 @@ class HsDevAgent(threading.Thread):
 
     @dirty
     def start_inspect(self):
+        # Everything is rescanned, e.g. after hsdev database was dropped
+        content_hashes.clear()
         self.mark_cabal()
         self.mark_all_files()
 
@@ -1303,48 +2195,202 @@ class HsDevAgent(threading.Thread):
     @use_inspect_modules
     def mark_all_files(self):
         window = sublime.active_window()
-        with self.dirty_files as dirty_files:
-            dirty_files.extend(list(filter(lambda f: f and f.endswith('.hs'), [v.file_name() for v in window.views()])))
-        with self.dirty_paths as dirty_paths:
-            dirty_paths.extend(window.folders())
+        for f in [v.file_name() for v in window.views()]:
+            if f and f.endswith('.hs'):
+                self.dirty_files.mark(f)
+        for p in window.folders():
+            self.dirty_paths.mark(p)
+        self.update_watcher()
+
+    def update_watcher(self):
+        """ Watch folders of active window, so that files changed outside of editor are rescanned """
+        if not get_setting_async('watch_files') or not get_setting_async('inspect_modules'):
+            return
+        if self.watcher is None:
+            self.watcher = watcher.FileWatcher(self.on_files_changed)
+            self.watcher.start()
+        self.watcher.set_roots(sublime.active_window().folders())
+
+    def stop_watcher(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def on_files_changed(self, changed, removed, paths):
+        """
+        Changes from watcher: files of projects are rescanned with their projects,
+        removed standalone files are removed from hsdev, directories are rescanned entirely
+        """
+        standalone_removed = []
+        for f in changed:
+            if not self.saved_in_editor(f):
+                self.mark_file_dirty(f)
+        for f in removed:
+            # Directory of removed file may be removed too
+            d = os.path.dirname(f)
+            while not os.path.isdir(d) and os.path.dirname(d) != d:
+                d = os.path.dirname(d)
+            if f.endswith('.cabal'):
+                self.mark_path_dirty(d)
+            elif get_cabal_project_dir_of_file(os.path.join(d, os.path.basename(f))) is not None:
+                self.mark_file_dirty(f)
+            else:
+                standalone_removed.append(f)
+        for p in paths:
+            self.mark_path_dirty(p)
+        if standalone_removed:
+            self.remove_files(standalone_removed)
+
+    def mark_file_saved(self, filename):
+        """ File saved in editor is rescanned urgently, watcher events of this save are ignored """
+        now = time.time()
+        mtime = file_mtime(filename)
+        with self.saved_files as saved:
+            for f in [f for f, (_, t) in saved.items() if now - t > HsDevAgent.saved_files_timeout]:
+                del saved[f]
+            if mtime is not None:
+                saved[filename] = (mtime, now)
+        self.mark_file_dirty(filename, urgent = True)
+
+    def saved_in_editor(self, filename):
+        """ Whether file is not modified since it was saved in editor """
+        with self.saved_files as saved:
+            entry = saved.get(filename)
+        return entry is not None and entry[0] == file_mtime(filename)
 
     @dirty
     @use_inspect_modules
-    def mark_file_dirty(self, filename):
+    def mark_file_dirty(self, filename, urgent = False):
+        """ Mark file for rescan, urgent (saved) files are rescanned before others and without delay """
         if filename is None:
             return
-        with self.dirty_files as dirty_files:
-            dirty_files.append(filename)
+        self.dirty_files.mark(filename, urgent = urgent)
+
+    @dirty
+    @use_inspect_modules
+    def mark_path_dirty(self, path):
+        self.dirty_paths.mark(path)
 
     @dirty
     def mark_cabal(self, cabal_name = None):
-        with self.cabal_to_load as cabal_to_load:
-            cabal_to_load.append(cabal_name or 'cabal')
+        self.cabal_to_load.mark(cabal_name or 'cabal')
+
+    def scan_job(self, **kwargs):
+        """
+        Scan job for run_scans: function of client and notification callback
+        Raises if scan fails: scan itself reports errors only via callback, and gets no response on timeout or lost connection
+        """
+        def job(client, on_notify):
+            (responded, errors) = ([], [])
+            client.scan(
+                on_notify = on_notify,
+                on_response = lambda r: responded.append(True),
+                on_error = lambda e, ds: errors.append(e),
+                wait = True,
+                docs = get_setting_async('enable_hdocs'),
+                **kwargs)
+            if errors or not responded:
+                raise Exception('scan failed: {0}'.format(errors[0] if errors else 'no response'))
+        return job
+
+    def run_scans(self, jobs, status):
+        """
+        Run scan jobs, list of (name, job), over pool of scan connections, each connection runs one job at time
+        Jobs must raise when scan fails, failures are logged and reported after all jobs finish
+        """
+        clients = [c for c in self.scan_clients if c.is_connected()] or [self.client_scan]
+        pending = queue.Queue()
+        for j in jobs:
+            pending.put(j)
+        errors = []
+
+        def worker(client):
+            while True:
+                try:
+                    (name, job) = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    job(client, status.job(name))
+                except Exception as e:
+                    log('scanning {0} failed: {1}'.format(name or 'files', e), log_error)
+                    errors.append((name, e))
+                finally:
+                    status.done(name)
+
+        if len(jobs) == 1 or len(clients) == 1:
+            worker(clients[0])
+        else:
+            workers = [threading.Thread(target = worker, args = (c,)) for c in clients[:len(jobs)]]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        if errors:
+            raise Exception('{0} of {1} scans failed: {2}'.format(len(errors), len(jobs), ', '.join(str(name or 'files') for (name, _) in errors)))
 
     @use_hsdev()
     def inspect_cabal(self, cabal = None):
+        self.inspect_cabals([cabal or 'cabal'])
+
+    @use_hsdev()
+    def inspect_cabals(self, cabals):
+        """ Scan cabal and sandboxes in parallel """
+        def scan_cabal(cabal):
+            scan = self.scan_job(cabal = (cabal == 'cabal'), sandboxes = [] if cabal == 'cabal' else [cabal])
+
+            def job(client, on_notify):
+                scan(client, on_notify)
+                if cabal == 'cabal':
+                    self.update_symbol_index(lambda m: m.by_cabal() and m.location.is_cabal(), cabal = True)
+                else:
+                    self.update_symbol_index(lambda m: m.by_cabal() and (m.location.sandbox() or '').startswith(cabal), sandbox = cabal)
+            return job
+
         try:
-            with status_message_process('Inspecting {0}'.format(cabal or 'cabal'), priority = 1) as s:
-                self.client_back.scan(cabal = (cabal == 'cabal'), sandboxes = [] if cabal == 'cabal' else [cabal], on_notify = scan_status(s), wait = True, docs = get_setting_async('enable_hdocs'))
+            with status_message_process('Inspecting {0}'.format(', '.join(cabals)), priority = 1) as s:
+                self.run_scans([(c, scan_cabal(c)) for c in cabals], scan_status(s))
         except Exception as e:
-            log('loading standard modules info for {0} failed with {1}'.format(cabal or 'cabal', e), log_error)
+            log('loading standard modules info failed: {0}'.format(e), log_error)
+        notify_inspected()
 
     @use_hsdev()
     @use_inspect_modules
-    def inspect(self, paths, projects, files):
+    def inspect(self, paths, projects, files, changed = None):
+        """
+        changed — files, that were modified, only they and their dependents are updated when scanning projects
+        """
         if paths or projects or files:
             try:
+                ghc = get_setting_async('ghc_opts')
+                if len(self.scan_clients) > 1:
+                    # Independent paths and projects are scanned in parallel, standalone files together
+                    jobs = [(('path', p), self.scan_job(paths = [p], ghc = ghc)) for p in paths]
+                    jobs.extend((('project', p), self.scan_job(projects = [p], ghc = ghc)) for p in projects)
+                    if files:
+                        jobs.append((None, self.scan_job(files = files, ghc = ghc)))
+                else:
+                    jobs = [(None, self.scan_job(paths = paths, projects = projects, files = files, ghc = ghc))]
                 with status_message_process('Inspecting', priority = 1) as s:
-                    self.client_back.scan(paths = paths, projects = projects, files = files, on_notify = scan_status(s), wait = True, ghc = get_setting_async('ghc_opts'), docs = get_setting_async('enable_hdocs'))
+                    self.run_scans(jobs, scan_status(s))
+                self.on_scanned(None if paths or projects else files)
+                # Declarations of changed files only are reloaded, whole sources only for path and initial project scans
+                self.update_sources_index(None if paths or (projects and not changed) else (changed or files))
+                notify_inspected(None if paths else (changed or files))
+                return True
             except Exception as e:
                 log('Inspection failed: {0}'.format(e), log_error)
+        return False
 
     @use_hsdev()
     @use_inspect_modules
     def inspect_path(self, path):
         try:
             with status_message_process('Inspecting path {0}'.format(path), priority = 1) as s:
-                self.client_back.scan(paths = [path], on_notify = scan_status(s), wait = True, ghc = get_setting_async('ghc_opts'), docs = get_setting_async('enable_hdocs'))
+                self.client_scan.scan(paths = [path], on_notify = scan_status(s), wait = True, ghc = get_setting_async('ghc_opts'), docs = get_setting_async('enable_hdocs'))
+            self.on_scanned()
+            self.update_sources_index()
+            notify_inspected()
         except Exception as e:
             log('Inspecting path {0} failed: {1}'.format(path, e), log_error)
 
@@ -1355,7 +2401,10 @@ class HsDevAgent(threading.Thread):
 
         try:
             with status_message_process('Inspecting project {0}'.format(project_name), priority = 1) as s:
-                self.client_back.scan(projects = [cabal_dir], on_notify = scan_status(s), wait = True, docs = get_setting_async('enable_hdocs'))
+                self.client_scan.scan(projects = [cabal_dir], on_notify = scan_status(s), wait = True, docs = get_setting_async('enable_hdocs'))
+            self.on_scanned()
+            self.update_sources_index()
+            notify_inspected()
         except Exception as e:
             log('Inspecting project {0} failed: {1}'.format(cabal_dir, e), log_error)
 
@@ -1364,10 +2413,54 @@ class HsDevAgent(threading.Thread):
     def inspect_files(self, filenames):
         try:
             with status_message_process('Inspecting files', priority = 1) as s:
-                self.client_back.scan(files = filenames, on_notify = scan_status(s), wait = True, ghc = get_setting_async('ghc_opts'), docs = get_setting_async('enable_hdocs'))
+                self.client_scan.scan(files = filenames, on_notify = scan_status(s), wait = True, ghc = get_setting_async('ghc_opts'), docs = get_setting_async('enable_hdocs'))
+            self.on_scanned(filenames)
+            self.update_sources_index(filenames)
+            notify_inspected(filenames)
         except Exception as e:
             log('Inspecting files failed: {0}'.format(e), log_error)
 
+    @use_hsdev()
+    def remove_files(self, filenames):
+        try:
+            self.client_scan.remove(files = filenames, wait = True)
+            content_hashes.drop('scan', filenames)
+            self.on_scanned(filenames)
+            self.update_sources_index(filenames)
+            notify_inspected(filenames)
+        except Exception as e:
+            log('Removing files failed: {0}'.format(e), log_error)
+
+    def on_scanned(self, files = None):
+        """
+        Sources were rescanned from disk (files or anything if None): previous scans of editor contents are replaced
+        and checks may give other results
+        """
+        content_hashes.drop('contents', files)
+        content_hashes.drop('check')
+
+    def update_symbol_index(self, drop, **filters):
+        """
+        Reload declarations of rescanned scope to local symbol index
+        drop — predicate on modules of this scope, they are removed from index (some of them may be deleted)
+        """
+        if not get_setting_async('enable_symbol_index'):
+            return
+        decls = self.client_scan.symbol(stream = True, timeout = None, **filters)
+        result = list(decls)
+        if decls.failed():
+            log('Updating symbol index failed: {0}'.format(decls.error[0]), log_error)
+            return
+        symbol_index.index.update(result, drop = drop)
+
+    def update_sources_index(self, files = None):
+        """ Update symbol index for rescanned files or for all sources if files not specified """
+        if files is None:
+            self.update_symbol_index(lambda m: m.by_source(), source = True)
+        else:
+            for f in files:
+                self.update_symbol_index(lambda m: m.by_source() and m.location.filename == f, file = f)
+
 
 class HsDevWindowCommand(SublimeHaskellWindowCommand):
     def is_enabled(self):
@@ -1389,6 +2482,7 @@ def start_agent():
     global agent
     global client
     global client_back
+    global client_scan
 
     if agent is not None:
         return
@@ -1398,4 +2492,5 @@ def start_agent():
     agent = HsDevAgent()
     client = agent.client
     client_back = agent.client_back
+    client_scan = agent.client_scan
     agent.start()
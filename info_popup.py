@@ -131,11 +131,12 @@ class SublimeHaskellPopup(sublime_plugin.EventListener):
 				# 		(t['note']['expr'] == self.whois_name),
 				# 	hsdev.client.types(files = [self.current_file_name]) or [])))
 
-				# Try whois
-				self.decl = head_of(hsdev.client.whois(self.whois_name, self.current_file_name))
+				# Try whois, then lookup; both are sent at once
+				(whois_decls, lookup_decls) = hsdev.client.batch([
+					hsdev.client.whois(self.whois_name, self.current_file_name, future = True),
+					hsdev.client.lookup(self.full_name, self.current_file_name, future = True)], timeout = 1)
 
-				if not self.decl:
-					self.decl = head_of(hsdev.client.lookup(self.full_name, self.current_file_name))
+				self.decl = head_of(whois_decls or []) or head_of(lookup_decls or [])
 
 				if typed_expr or self.decl:
 					popup_parts = [styles.gen_style(self.view.settings().get('color_scheme'))]
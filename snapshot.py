@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+
+import glob
+import marshal
+import os
+import threading
+import sublime
+
+if int(sublime.version()) < 3000:
+    from sublime_haskell_common import *
+    import hsdev
+    import symbols
+    import symbol_index
+else:
+    from SublimeHaskell.sublime_haskell_common import *
+    import SublimeHaskell.hsdev as hsdev
+    import SublimeHaskell.symbols as symbols
+    import SublimeHaskell.symbol_index as symbol_index
+
+
+# Snapshot of prepared completions and symbol index, saved in cache and loaded on start,
+# so that they are available before hsdev is started and has rescanned everything
+# Entries for changed files are skipped on load, entries of installed packages are loaded only if package dbs didn't change
+# Strings are stored joined with newlines, which is much faster to load than many small tuples
+snapshot_version = 1
+
+
+def join_lines(strs):
+    return u'\n'.join(s.replace(u'\n', u' ') for s in strs)
+
+
+def split_lines(s):
+    return s.split(u'\n') if s else []
+
+
+def snapshot_path():
+    return os.path.join(sublime_haskell_cache_path(), 'snapshot.dat')
+
+
+def file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError):
+        return None
+
+
+ghc_libdirs = LockedObject({})  # (PATH additions, ghc options) ⇒ ghc libdir or None
+
+
+def ghc_libdir():
+    """ Libdir of ghc, which is run once for current PATH and ghc options """
+    key = (tuple(get_setting_async('add_to_PATH', [])), tuple(get_setting_async('ghc_opts', [])))
+    with ghc_libdirs as libdirs:
+        if key in libdirs:
+            return libdirs[key]
+    libdir = None
+    try:
+        (exit_code, out, _) = call_and_wait(['ghc', '--print-libdir'])
+        if exit_code == 0 and out.strip():
+            libdir = out.strip()
+    except OSError:
+        pass
+    with ghc_libdirs as libdirs:
+        libdirs[key] = libdir
+    return libdir
+
+
+def package_dbs_signature(dbs = []):
+    """ Modification times of global, user and specified package dbs """
+    paths = set(dbs)
+    paths.update(glob.glob(os.path.join(os.path.expanduser('~'), '.ghc', '*', 'package.conf.d')))
+    libdir = ghc_libdir()
+    if libdir:
+        paths.add(os.path.join(libdir, 'package.conf.d'))
+    return sorted((p, file_mtime(p)) for p in paths)
+
+
+def encode_location(loc):
+    """ Location as dict, that hsdev.parse_location accepts, None if there is no location """
+    if isinstance(loc, symbols.Location):
+        return {'file': loc.filename, 'project': loc.project}
+    if isinstance(loc, symbols.InstalledLocation):
+        db = None
+        if loc.db is not None:
+            db = {'package-db': loc.db.package_db} if loc.db.package_db else loc.db.to_string()
+        return {
+            'package': loc.package.package_id() if loc.package else None,
+            'db': db}
+    if isinstance(loc, symbols.OtherLocation):
+        return {'source': loc.source}
+    return None
+
+
+def dump(cache, groups):
+    """ Snapshot of completion cache and symbol index groups """
+    modules = []
+    package_dbs = set()
+    for es in groups:
+        m = es[0].module
+        loc = encode_location(m.location)
+        if loc is None:
+            continue
+        if isinstance(m.location, symbols.InstalledLocation) and m.location.db is not None and m.location.db.package_db:
+            package_dbs.add(m.location.db.package_db)
+        mtime = file_mtime(m.location.filename) if m.by_source() else None
+        modules.append((m.name, loc, mtime, join_lines(e.name for e in es), join_lines(e.brief for e in es)))
+    files = []
+    for (filename, index) in cache.files.items():
+        if filename not in cache.file_modules:
+            continue
+        (imports_key, project) = cache.file_info(filename)
+        files.append((
+            filename, file_mtime(filename), cache.file_modules[filename], project, list(imports_key),
+            join_lines(c[0] for c in index.comps), join_lines(c[1] for c in index.comps)))
+    return {
+        'version': snapshot_version,
+        'package_dbs': package_dbs_signature(package_dbs),
+        'modules': modules,
+        'files': files}
+
+
+def save(cache, groups):
+    path = snapshot_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        marshal.dump(dump(cache, groups), f)
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, path)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def load():
+    """ Load snapshot, returns None if there is no valid snapshot """
+    try:
+        with open(snapshot_path(), 'rb') as f:
+            snap = marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if type(snap) != dict or snap.get('version') != snapshot_version:
+        return None
+    return snap
+
+
+def restore(snap, set_files):
+    """
+    Restore symbol index and completions from snapshot, skipping changed files
+    set_files(filename, comps, module) — function to put completions to cache
+    Returns number of restored modules and files
+    """
+    dbs_valid = package_dbs_signature([p for (p, _) in snap['package_dbs']]) == [tuple(d) for d in snap['package_dbs']]
+
+    # Completions include installed declarations, so they are valid only if package dbs are the same
+    files = 0
+    if dbs_valid:
+        for (filename, mtime, module_name, project, imports, comps, inserts) in snap['files']:
+            if mtime is None or file_mtime(filename) != mtime:
+                continue
+            module = symbols.Module(
+                module_name,
+                imports = [symbols.Import(m, q, a or None) for (m, q, a) in imports],
+                location = symbols.Location(filename, project))
+            set_files(filename, list(zip(split_lines(comps), split_lines(inserts))), module)
+            files += 1
+
+    groups = []
+    for (name, loc, mtime, names, briefs) in snap['modules']:
+        if not loc:
+            continue
+        if 'file' in loc:
+            if mtime is None or file_mtime(loc['file']) != mtime:
+                continue
+        elif not dbs_valid:
+            continue
+        module = hsdev.parse_module_id({'name': name, 'location': loc})
+        groups.append([symbol_index.SymbolEntry(n, b, module) for (n, b) in zip(split_lines(names), split_lines(briefs))])
+    if get_setting_async('enable_symbol_index'):
+        symbol_index.index.add_entries(groups)
+    return (len(groups), files)
+
+
+class SnapshotWriter(object):
+    """
+    Saves snapshot in background some time after last change, so that many changes are saved at once
+    """
+    save_delay = 30.0
+
+    def __init__(self, save_fn):
+        self.save_fn = save_fn
+        self.timer_lock = threading.Lock()
+        self.timer = None
+
+    def schedule(self):
+        if not get_setting_async('completions_snapshot'):
+            return
+        with self.timer_lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(SnapshotWriter.save_delay, self.save)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def save(self):
+        with self.timer_lock:
+            self.timer = None
+        try:
+            self.save_fn()
+        except Exception as e:
+            log('saving snapshot failed: {0}'.format(e), log_error)
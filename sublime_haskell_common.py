@@ -73,6 +73,13 @@ def preload_settings():
     # Now we can use get_setting_async for 'add_to_PATH' safely
     get_setting('add_to_PATH')
     get_setting('enable_auto_build')
+    get_setting('completions_limit')
+    get_setting('completions_cache_files')
+    get_setting('completions_cache_size')
+    get_setting('completions_snapshot')
+    get_setting('prefetch_completions')
+    get_setting('prefetch_completions_budget')
+    get_setting('prefetch_recent_files')
     get_setting('haskell_build_tool')
     get_setting('show_error_window')
     get_setting('show_output_window')
@@ -81,7 +88,19 @@ def preload_settings():
     get_setting('enable_hdocs')
     get_setting('enable_hsdev')
     get_setting('hsdev_log_config')
+    get_setting('hsdev_cache_size')
+    get_setting('hsdev_connection')
+    get_setting('hsdev_port')
+    get_setting('hsdev_socket_path')
+    get_setting('enable_symbol_index')
     get_setting('inspect_modules')
+    get_setting('inspect_debounce')
+    get_setting('inspect_batch_size')
+    get_setting('interactive_yield_timeout')
+    get_setting('scan_concurrency')
+    get_setting('watch_files')
+    get_setting('watch_poll_interval')
+    get_setting('watch_exclude_dirs')
     get_setting('snippet_replace')
     get_setting('lint_check_fly')
     get_setting('lint_check_fly_idle')
@@ -0,0 +1,410 @@
+# -*- coding: UTF-8 -*-
+
+import bisect
+import heapq
+import re
+import sublime
+
+if int(sublime.version()) < 3000:
+    from sublime_haskell_common import *
+    import symbols
+else:
+    from SublimeHaskell.sublime_haskell_common import *
+    import SublimeHaskell.symbols as symbols
+
+
+class SymbolEntry(object):
+    """
+    Compact declaration in index: name, brief info and (shared) module
+    """
+    __slots__ = ('name', 'brief', 'module')
+
+    def __init__(self, name, brief, module):
+        self.name = name
+        self.brief = brief
+        self.module = module
+
+    def declaration(self):
+        """ Declaration with name and module, enough for symbol info and goto """
+        return IndexedDeclaration(self)
+
+
+class IndexedDeclaration(symbols.Declaration):
+    """
+    Declaration from symbol index, with only brief info known
+    """
+    __slots__ = ('brief_info',)
+
+    def __init__(self, entry):
+        super(IndexedDeclaration, self).__init__(entry.name, module = entry.module)
+        self.brief_info = entry.brief
+
+    def brief(self, short = False):
+        return self.name if short else self.brief_info
+
+
+def module_key(m):
+    if m is None:
+        return None
+    if m.location is None:
+        return m.name
+    return m.get_location_id()
+
+
+def is_boundary(text, i):
+    """ Whether text[i] starts word: at start, after '.', '_' or ''', or camelCase hump """
+    if i == 0:
+        return True
+    prev = text[i - 1]
+    return prev in "._'" or (text[i].isupper() and not prev.isupper())
+
+
+def fuzzy_score(query, text):
+    """
+    Score of query being subsequence of text (case-insensitive), None if it isn't
+    Matches at word starts and consecutive matches are scored higher, exact case adds a bit
+    """
+    if not query:
+        return 0
+    lquery = query.lower()
+    ltext = text.lower()
+    score = 0
+    qi = 0
+    prev = -2
+    for i, c in enumerate(ltext):
+        if c != lquery[qi]:
+            continue
+        score += 1
+        if is_boundary(text, i):
+            score += 3
+        if prev == i - 1:
+            score += 2
+        if text[i] == query[qi]:
+            score += 1
+        prev = i
+        qi += 1
+        if qi == len(lquery):
+            return score
+    return None
+
+
+def subsequence_regex(query, word_start = False):
+    """
+    Regex for lowercased lines, containing query as subsequence
+    It starts with literal, so that regex engine can skip to its occurrences quickly,
+    and uses negated classes to match leftmost subsequence without backtracking
+    word_start — first char must start line or dot-separated part
+    """
+    q = query.lower()
+    return re.compile((u'(?<![^.\\n])' if word_start else u'') + re.escape(q[0]) + u''.join(u'[^{0}\\n]*{0}'.format(re.escape(c)) for c in q[1:]))
+
+
+module_name_re = re.compile(r"[A-Z][\w']*(?:\.[A-Z][\w']*)*$")
+qualified_query_re = re.compile(r"([A-Z][\w']*(?:\.[A-Z][\w']*)*)\.(.+)$")
+
+
+def split_query(query):
+    """
+    Module qualifier and name of query, qualifier is split off only if it is valid module name,
+    so that operators with dots ('.', '<.>', '.&.') are searched as names, operators can be in parentheses
+    """
+    query = query.strip()
+    if len(query) > 2 and query.startswith('(') and query.endswith(')'):
+        query = query[1:-1]
+    if query.endswith('.') and module_name_re.match(query[:-1]):
+        return (query[:-1], '')
+    m = qualified_query_re.match(query)
+    if m:
+        return (m.group(1), m.group(2))
+    return ('', query)
+
+
+class SymbolSnapshot(object):
+    """
+    Search structures, built from index entries: unique lowercased names and module names joined in strings
+    runs — module key ⇒ [SymbolEntry], entries of snapshot
+    """
+    def __init__(self, runs):
+        by_name = {}
+        by_module = {}
+        count = 0
+        for es in runs.values():
+            count += len(es)
+            for e in es:
+                by_name.setdefault(e.name, []).append(e)
+                by_module.setdefault(e.module.name, []).append(e)
+        self.runs = runs
+        self.module_entries = by_module
+        # Short names first, they are preferred when there are too many candidates
+        self.names = sorted(by_name.keys(), key = name_key)
+        self.name_entries = [sorted(by_name[n], key = lambda e: not e.module.by_source()) for n in self.names]
+        (self.names_blob, self.names_offsets) = SymbolSnapshot.join(self.names)
+        self.modules = sorted(by_module.keys())
+        (self.modules_blob, self.modules_offsets) = SymbolSnapshot.join(self.modules)
+        self.count = count
+
+    @staticmethod
+    def join(strs):
+        offsets = []
+        pos = 0
+        for s in strs:
+            offsets.append(pos)
+            pos += len(s) + 1
+        return (u'\n'.join(strs).lower() + u'\n', offsets)
+
+    @staticmethod
+    def matches(regex, blob, offsets):
+        """ Indices of lines matching regex """
+        last = -1
+        for m in regex.finditer(blob):
+            i = bisect.bisect_right(offsets, m.start()) - 1
+            if i != last:
+                last = i
+                yield i
+
+    def matching_modules(self, module_query):
+        """ Module names matching query """
+        regex = subsequence_regex(module_query, word_start = True)
+        return [self.modules[i] for i in SymbolSnapshot.matches(regex, self.modules_blob, self.modules_offsets)]
+
+    def candidates(self, name_regex, module_names = None):
+        """
+        Names matching regex with their entries, short names first
+        module_names — look only through declarations of these modules
+        """
+        if module_names is not None:
+            by_name = {}
+            for m in module_names:
+                for e in self.module_entries.get(m, []):
+                    if name_regex.search(e.name.lower()):
+                        by_name.setdefault(e.name, []).append(e)
+            return ((n, by_name[n]) for n in sorted(by_name.keys(), key = name_key))
+        return ((self.names[i], self.name_entries[i]) for i in SymbolSnapshot.matches(name_regex, self.names_blob, self.names_offsets))
+
+
+def name_key(name):
+    return (len(name), name)
+
+
+def merge_candidates(layers):
+    """
+    Merge candidates of snapshot layers, which are ordered by name_key, into one stream, joining entries with same name
+    layers — [(candidates, entries filter or None)]
+    """
+    def keyed(i, cands, pred):
+        for (name, entries) in cands:
+            if pred is not None:
+                entries = [e for e in entries if pred(e)]
+                if not entries:
+                    continue
+            yield (len(name), name, i, entries)
+
+    (cur_name, cur_entries) = (None, [])
+    for (_, name, _, entries) in heapq.merge(*[keyed(i, cands, pred) for (i, (cands, pred)) in enumerate(layers)]):
+        if name != cur_name:
+            if cur_entries:
+                yield (cur_name, cur_entries)
+            (cur_name, cur_entries) = (name, list(entries))
+        else:
+            cur_entries.extend(entries)
+    if cur_entries:
+        yield (cur_name, cur_entries)
+
+
+class SymbolIndex(object):
+    """
+    Local fuzzy search over scanned declarations
+    Entries are grouped by module, so rescanned modules replace their entries
+    Search runs compiled subsequence regex over one string of all unique names to select candidates,
+    which are then scored in Python, so time depends mostly on number of candidates, which is limited
+    Search structures are built in two layers: base snapshot of all modules and small delta of modules changed since.
+    Update patches only delta, base is rebuilt by updating thread, when delta grows, searches use previous one meanwhile
+    """
+    max_candidates = 1000
+    max_module_entries = 50000
+    min_rebuild_entries = 10000  # rebuild base, when delta has more entries and...
+    rebuild_ratio = 0.05  # ...this part of base
+
+    def __init__(self):
+        self.modules = LockedObject({})  # module key ⇒ [SymbolEntry]
+        self.count = 0
+        self.base = SymbolSnapshot({})  # snapshot of all modules at some moment
+        self.stale = set()  # keys of modules in base, which were changed or removed
+        self.fresh = {}  # module key ⇒ [SymbolEntry], modules set since base was built
+        self.fresh_count = 0
+        self.delta = None  # SymbolSnapshot of fresh, built on search
+        self.stale_modules = None  # ids of modules of stale entries, built on search
+        self.rebuilding = False
+
+    def set_module(self, ms, k, es):
+        """ Set or remove (es is None) module entries, must be called with lock """
+        old = ms.pop(k, None)
+        if old is not None:
+            self.count -= len(old)
+        if k in self.base.runs:
+            self.stale.add(k)
+        old = self.fresh.pop(k, None)
+        if old is not None:
+            self.fresh_count -= len(old)
+        if es is not None:
+            ms[k] = es
+            self.count += len(es)
+            self.fresh[k] = es
+            self.fresh_count += len(es)
+        self.delta = None
+        self.stale_modules = None
+
+    def update(self, decls, drop = None):
+        """
+        Set entries for modules of declarations
+        drop — predicate on module, modules of rescanned scope to remove before update
+        """
+        groups = {}
+        for decl in decls or []:
+            if decl is None or decl.module is None:
+                continue
+            groups.setdefault(module_key(decl.module), []).append(SymbolEntry(decl.name, decl.brief(), decl.module))
+        with self.modules as ms:
+            if drop is not None:
+                for k in [k for k, es in ms.items() if es and drop(es[0].module) and k not in groups]:
+                    self.set_module(ms, k, None)
+            for k, es in groups.items():
+                self.set_module(ms, k, es)
+        self.refresh()
+
+    def add_entries(self, groups):
+        """
+        Add entries, grouped by module, for modules not indexed yet (loaded from snapshot must not replace scanned)
+        """
+        with self.modules as ms:
+            for es in groups:
+                if es and module_key(es[0].module) not in ms:
+                    self.set_module(ms, module_key(es[0].module), es)
+        self.refresh()
+
+    def groups(self):
+        """ Entries grouped by module """
+        with self.modules as ms:
+            return [es for es in ms.values() if es]
+
+    def clear(self):
+        with self.modules as ms:
+            ms.clear()
+            self.count = 0
+            self.base = SymbolSnapshot({})
+            self.stale = set()
+            self.fresh = {}
+            self.fresh_count = 0
+            self.delta = None
+            self.stale_modules = None
+
+    def refresh(self):
+        """
+        Rebuild base snapshot if delta is too large, called by updating thread
+        Changes made while building are left in delta of new base
+        Delta is prepared here too, so that search doesn't wait for it
+        """
+        with self.modules as ms:
+            if self.rebuilding or self.fresh_count < max(SymbolIndex.min_rebuild_entries, self.base.count * SymbolIndex.rebuild_ratio):
+                self.get_layers()
+                return
+            self.rebuilding = True
+            runs = dict(ms)
+        try:
+            base = SymbolSnapshot(runs)
+        except Exception:
+            with self.modules:
+                self.rebuilding = False
+            raise
+        with self.modules as ms:
+            self.rebuilding = False
+            self.base = base
+            self.stale = set(k for k, es in runs.items() if ms.get(k) is not es)
+            self.fresh = dict((k, es) for k, es in ms.items() if runs.get(k) is not es)
+            self.fresh_count = sum(len(es) for es in self.fresh.values())
+            self.delta = None
+            self.stale_modules = None
+            self.get_layers()
+
+    def get_layers(self):
+        """ Base snapshot, delta snapshot and ids of modules of base entries, which must be skipped """
+        with self.modules:
+            if self.delta is None:
+                self.delta = SymbolSnapshot(dict(self.fresh))
+            if self.stale_modules is None:
+                self.stale_modules = frozenset(id(e.module) for k in self.stale for e in self.base.runs[k])
+            return (self.base, self.delta, self.stale_modules)
+
+    def is_empty(self):
+        with self.modules as ms:
+            return len(ms) == 0
+
+    def __len__(self):
+        with self.modules:
+            return self.count
+
+    def search(self, query, limit = 100):
+        """
+        Search declarations with fuzzy query, returns best SymbolEntry first
+        Qualified query as 'M.ins' or 'Data.Map.ins' matches module name too
+        """
+        (base, delta, stale) = self.get_layers()
+        base_pred = (lambda e: id(e.module) not in stale) if stale else None
+        (module_query, name_query) = split_query(query)
+        if not name_query:
+            return []
+
+        module_scores = None
+        if module_query:
+            module_scores = {}
+            for m in set(base.matching_modules(module_query)) | set(delta.matching_modules(module_query)):
+                score = fuzzy_score(module_query, m)
+                if score is not None:
+                    module_scores[m] = score
+            if not module_scores:
+                return []
+
+        name_regex = subsequence_regex(name_query)
+        module_names = None
+        if module_scores is not None and sum(len(s.module_entries.get(m, [])) for s in (base, delta) for m in module_scores) < SymbolIndex.max_module_entries:
+            # Few matching modules: look through their declarations instead of all names
+            module_names = module_scores.keys()
+        candidates = merge_candidates([
+            (base.candidates(name_regex, module_names), base_pred),
+            (delta.candidates(name_regex, module_names), None)])
+
+        scored = []
+        for i, (name, entries) in enumerate(candidates):
+            module_score = 0
+            if module_scores is not None:
+                entries = [e for e in entries if e.module.name in module_scores]
+                if not entries:
+                    continue
+                module_score = max(module_scores[e.module.name] for e in entries)
+            score = fuzzy_score(name_query, name)
+            if score is None:
+                continue
+            if name == name_query:
+                score += 10
+            scored.append((-(score + module_score), len(name), i, entries))
+            if len(scored) >= SymbolIndex.max_candidates:
+                break
+
+        result = []
+        for (_, _, _, entries) in heapq.nsmallest(limit, scored):
+            entries = sorted(entries, key = (lambda e: -module_scores[e.module.name]) if module_scores is not None else (lambda e: not e.module.by_source()))
+            result.extend(entries[:limit - len(result)])
+            if len(result) >= limit:
+                break
+        return result
+
+    def stats(self):
+        with self.modules as ms:
+            return {
+                'modules': len(ms),
+                'declarations': self.count,
+                'delta_modules': len(self.fresh),
+                'stale_modules': len(self.stale)}
+
+
+index = SymbolIndex()
@@ -3,16 +3,67 @@
 import html
 import re
 import sublime
+import sys
 import os.path
+import weakref
 
 if int(sublime.version()) < 3000:
     from sublime_haskell_common import *
+    intern_string = intern
 else:
     from SublimeHaskell.sublime_haskell_common import *
     from functools import reduce
+    intern_string = sys.intern
+
+
+class InternTable(object):
+    """
+    Table of shared equal objects, so that thousands of declarations from one module refer to one module object
+    Objects must not be modified after interning; they are held weakly and dropped when no one uses them
+    Counters are updated without lock, so they are approximate when parsing in several threads
+    """
+    def __init__(self):
+        self.objects = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0
+
+    def get(self, key, make):
+        """ Get object by key or make new one """
+        obj = self.objects.get(key)
+        if obj is not None:
+            self.hits += 1
+            self.saved += sys.getsizeof(obj)
+            return obj
+        self.misses += 1
+        obj = make()
+        if obj is not None:
+            self.objects[key] = obj
+        return obj
+
+    def stats(self):
+        return {
+            'entries': len(self.objects),
+            'hits': self.hits,
+            'misses': self.misses,
+            'saved_bytes': self.saved}
+
+
+interned = {
+    'packages': InternTable(),
+    'package_dbs': InternTable(),
+    'locations': InternTable(),
+    'modules': InternTable()}
+
+
+def interning_stats():
+    """ Stats of intern tables, 'saved_bytes' is shallow size of objects shared instead of allocated """
+    return dict((name + ' ' + k, v) for name, table in interned.items() for k, v in table.stats().items())
 
 
 class Position(object):
+    __slots__ = ('line', 'column')
+
     def __init__(self, line, column):
         self.line = line
         self.column = column
@@ -36,6 +87,8 @@ class Location(object):
     """
     Location in file at line
     """
+    __slots__ = ('project', 'filename', '__weakref__')
+
     def __init__(self, filename, project = None):
         self.project = project
         self.filename = filename
@@ -61,6 +114,8 @@ def source_location(loc, pos):
 
 
 class Package(object):
+    __slots__ = ('name', 'version', '__weakref__')
+
     def __init__(self, name, version = None):
         self.name = name
         self.version = version
@@ -72,18 +127,24 @@ class Package(object):
 def parse_package(package_id):
     if package_id is None:
         return None
+    return interned['packages'].get(package_id, lambda: parse_package_id(package_id))
+
+
+def parse_package_id(package_id):
     m = re.match('([\w\-]+)\-([\d\.]+)', package_id)
     if m:
         (name, version) = m.groups()
-        return Package(name, version)
+        return Package(intern_string(name), intern_string(version))
     m = re.match('([\w\-]+)', package_id)
     if m:
         (name, ) = m.groups()
-        return Package(name)
+        return Package(intern_string(name))
     return None
 
 
 class PackageDb(object):
+    __slots__ = ('global_db', 'user_db', 'package_db', '__weakref__')
+
     def __init__(self, global_db = False, user_db = False, package_db = None):
         self.global_db = False
         self.user_db = False
@@ -122,6 +183,8 @@ class InstalledLocation(object):
     """
     Module location in cabal
     """
+    __slots__ = ('package', 'db', '__weakref__')
+
     def __init__(self, package, db = PackageDb(global_db = True)):
         self.package = package
         self.db = db
@@ -149,6 +212,8 @@ class OtherLocation(object):
     """
     Other module location
     """
+    __slots__ = ('source', '__weakref__')
+
     def __init__(self, source):
         self.source = source
 
@@ -187,17 +252,28 @@ class Symbol(object):
     """
     Haskell symbol: module, function, data, class etc.
     """
+    __slots__ = ('what', 'name', '_tags')
+
     def __init__(self, symbol_type, name):
         self.what = symbol_type
         self.name = name
 
-        self.tags = {}
+        self._tags = None
+
+    @property
+    def tags(self):
+        """ Created on first use, most symbols never have tags """
+        if self._tags is None:
+            self._tags = {}
+        return self._tags
 
 
 class Import(object):
     """
     Haskell import of module
     """
+    __slots__ = ('module', 'is_qualified', 'import_as', 'position', 'location')
+
     def __init__(self, module_name, is_qualified = False, import_as = None, position = None, location = None):
         self.module = module_name
         self.is_qualified = is_qualified
@@ -206,7 +282,7 @@ class Import(object):
         self.location = location
 
     def dump(self):
-        return self.__dict__
+        return dict((k, getattr(self, k)) for k in Import.__slots__)
 
 
 def module_location(filename):
@@ -217,12 +293,13 @@ class Module(Symbol):
     """
     Haskell module symbol
     """
+    __slots__ = ('location', 'exports', 'imports', 'declarations', 'last_inspection_time', '__weakref__')
+
     def __init__(self, module_name, exports = None, imports = [], declarations = {}, location = None, last_inspection_time = 0):
         super(Module, self).__init__('module', module_name)
         self.location = location
         # List of strings
-        if exports is not None:
-            self.exports = exports[:]
+        self.exports = exports[:] if exports is not None else None
         # Dictionary from module name to Import object
         self.imports = imports[:]
         for i in self.imports:
@@ -284,13 +361,52 @@ def escape_text(txt):
 
 
 class Declaration(Symbol):
+    """
+    Haskell declaration
+    'docs', 'imported' and 'defined' can be set lazy with 'set_lazy', they are built on first access
+    """
+    __slots__ = ('lazy', 'parsers', '_docs', '_imported', '_defined', 'position', 'module', 'location')
+
     def __init__(self, name, decl_type = 'declaration', docs = None, imported = [], defined = None, position = None, module = None):
         super(Declaration, self).__init__(decl_type, name)
+        self.lazy = ()
+        self.parsers = None
         self.docs = docs
         self.imported = imported[:]
         self.defined = defined
         self.position = position
         self.module = module
+        self.location = None
+
+    def set_lazy(self, parsers, **fields):
+        """
+        Each field will be built with parsers[field](raw) on first access, where raw is passed value
+        parsers may also contain 'imported_modules' to get names of imported modules without building 'imported'
+        """
+        self.parsers = parsers
+        self.lazy = tuple(sorted(fields.keys()))
+        for field, raw in fields.items():
+            setattr(self, '_' + field, raw)
+
+    def get_lazy(self, field):
+        if field in self.lazy:
+            self.set_field(field, self.parsers[field](getattr(self, '_' + field)))
+        return getattr(self, '_' + field)
+
+    def set_field(self, field, value):
+        if field in self.lazy:
+            self.lazy = tuple(f for f in self.lazy if f != field)
+        setattr(self, '_' + field, value)
+
+    docs = property(lambda self: self.get_lazy('docs'), lambda self, value: self.set_field('docs', value))
+    imported = property(lambda self: self.get_lazy('imported'), lambda self, value: self.set_field('imported', value))
+    defined = property(lambda self: self.get_lazy('defined'), lambda self, value: self.set_field('defined', value))
+
+    def imported_modules(self):
+        """ Names of modules, declaration is imported from, in import order """
+        if 'imported' in self.lazy and 'imported_modules' in self.parsers:
+            return self.parsers['imported_modules'](self._imported)
+        return [i.module for i in self.imported]
 
     def defined_module(self):
         return self.defined or self.module
@@ -316,13 +432,15 @@ class Declaration(Symbol):
         self.name = self.qualified_name()
 
     def module_name(self):
-        if self.imported:
-            return self.imported[0].module
+        imodules = self.imported_modules()
+        if imodules:
+            return imodules[0]
         return self.module.name
 
     def imported_names(self):
-        if self.imported:
-            return sorted(list(set([i.module for i in self.imported])))
+        imodules = self.imported_modules()
+        if imodules:
+            return sorted(list(set(imodules)))
         # if self.module:
         #     return [self.module.name]
         return []
@@ -330,11 +448,19 @@ class Declaration(Symbol):
     def imported_from_name(self):
         inames = self.imported_names()
         if inames:
-            return self.imported_names()[0]
+            return inames[0]
         return ''
 
+    def completion(self):
+        """ Returns (sort key, suggestion), completions are sorted by lowercased inserted text """
+        suggestion = self.make_suggestion()
+        return (intern_string(suggestion[1].lower()), suggestion)
+
     def suggest(self):
         """ Returns suggestion for this declaration """
+        return self.completion()[1]
+
+    def make_suggestion(self):
         return ('{0}\t{1}'.format(self.name, self.imported_from_name()), self.name)
 
     def brief(self, short = False):
@@ -437,11 +563,13 @@ class Function(Declaration):
     """
     Haskell function declaration
     """
+    __slots__ = ('type',)
+
     def __init__(self, name, function_type, docs = None, imported = [], defined = None, position = None, module = None):
         super(Function, self).__init__(name, 'function', docs, imported, defined, position, module)
         self.type = function_type
 
-    def suggest(self):
+    def make_suggestion(self):
         return (u'{0} :: {1}\t{2}'.format(wrap_operator(self.name), self.type, self.imported_from_name()), self.name)
 
     def brief(self, short = False):
@@ -460,13 +588,15 @@ class TypeBase(Declaration):
     """
     Haskell type, data or class
     """
+    __slots__ = ('context', 'args', 'definition')
+
     def __init__(self, name, decl_type, context, args, definition = None, docs = None, imported = [], defined = None, position = None, module = None):
         super(TypeBase, self).__init__(name, decl_type, docs, imported, defined, position, module)
         self.context = context
         self.args = args
         self.definition = definition
 
-    def suggest(self):
+    def make_suggestion(self):
         return (u'{0} {1}\t{2}'.format(self.name, ' '.join(self.args), self.imported_from_name()), self.name)
 
     def brief(self, short = False):
@@ -516,6 +646,8 @@ class Type(TypeBase):
     """
     Haskell type synonym
     """
+    __slots__ = ()
+
     def __init__(self, name, context, args, definition = None, docs = None, imported = [], defined = None, position = None, module = None):
         super(Type, self).__init__(name, 'type', context, args, definition, docs, imported, defined, position, module)
 
@@ -524,6 +656,8 @@ class Newtype(TypeBase):
     """
     Haskell newtype synonym
     """
+    __slots__ = ()
+
     def __init__(self, name, context, args, definition = None, docs = None, imported = [], defined = None, position = None, module = None):
         super(Newtype, self).__init__(name, 'newtype', context, args, definition, docs, imported, defined, position, module)
 
@@ -532,6 +666,8 @@ class Data(TypeBase):
     """
     Haskell data declaration
     """
+    __slots__ = ()
+
     def __init__(self, name, context, args, definition = None, docs = None, imported = [], defined = None, position = None, module = None):
         super(Data, self).__init__(name, 'data', context, args, definition, docs, imported, defined, position, module)
 
@@ -540,6 +676,8 @@ class Class(TypeBase):
     """
     Haskell class declaration
     """
+    __slots__ = ()
+
     def __init__(self, name, context, args, definition = None, docs = None, imported = [], defined = None, position = None, module = None):
         super(Class, self).__init__(name, 'class', context, args, definition, docs, imported, defined, position, module)
 
@@ -0,0 +1,258 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import select
+import struct
+import sys
+import threading
+import sublime
+
+if int(sublime.version()) < 3000:
+    from sublime_haskell_common import *
+else:
+    from SublimeHaskell.sublime_haskell_common import *
+
+
+# Watch project folders for changes of sources and .cabal files made outside of editor (vcs, code generators, builds)
+# Uses inotify on Linux and falls back to polling modification times elsewhere or if inotify fails
+
+def is_watched_file(path):
+    return path.endswith('.hs') or path.endswith('.lhs') or path.endswith('.cabal')
+
+
+def is_excluded_dir(name):
+    return name.startswith('.') or name in get_setting_async('watch_exclude_dirs', [])
+
+
+def walk_dirs(root):
+    """ Directories under root, excluding build and vcs ones """
+    for (dirpath, dirnames, _) in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not is_excluded_dir(d)]
+        yield dirpath
+
+
+def walk_files(root):
+    """ Watched files with their modification times """
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not is_excluded_dir(d)]
+        for f in filenames:
+            if is_watched_file(f):
+                path = os.path.join(dirpath, f)
+                try:
+                    yield (path, os.path.getmtime(path))
+                except OSError:
+                    pass
+
+
+def fs_encode(path):
+    return path.encode(sys.getfilesystemencoding()) if isinstance(path, type(u'')) else path
+
+
+def fs_decode(path):
+    return path.decode(sys.getfilesystemencoding(), 'replace') if isinstance(path, bytes) else path
+
+
+class Inotify(object):
+    """
+    Linux inotify through ctypes, constructor raises OSError if it's not available
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        try:
+            import ctypes
+            import ctypes.util
+        except ImportError as e:
+            raise OSError(str(e))
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno = True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError('inotify is not supported')
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise self.error('inotify_init')
+        self.dirs = {}  # watch descriptor ⇒ directory
+
+    def error(self, fn):
+        errno = self.ctypes.get_errno()
+        return OSError(errno, '{0}: {1}'.format(fn, os.strerror(errno)))
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, fs_encode(path), Inotify.watch_mask)
+        if wd < 0:
+            raise self.error('inotify_add_watch')
+        self.dirs[wd] = path
+
+    def read(self, timeout):
+        """ Events as list of (path, mask), empty on timeout """
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos + Inotify.event_header.size <= len(data):
+            (wd, mask, _, name_len) = Inotify.event_header.unpack_from(data, pos)
+            pos += Inotify.event_header.size
+            name = fs_decode(data[pos:pos + name_len].rstrip(b'\0'))
+            pos += name_len
+            if mask & Inotify.IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            path = self.dirs.get(wd)
+            if mask & Inotify.IN_IGNORED:
+                self.dirs.pop(wd, None)
+            if path is not None:
+                events.append((os.path.join(path, name) if name else path, mask))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.dirs = {}
+
+
+class FileWatcher(threading.Thread):
+    """
+    Watches source files and .cabal files in roots, calls on_changes(changed, removed, paths) from its thread
+    paths — directories to rescan entirely, when precise changes are unknown (inotify queue overflow, removed directory)
+    """
+    max_burst = 10000  # max events reported at once
+
+    def __init__(self, on_changes):
+        super(FileWatcher, self).__init__()
+        self.daemon = True
+        self.on_changes = on_changes
+        self.roots = LockedObject([])
+        self.roots_changed = threading.Event()
+        self.stop_event = threading.Event()
+        self.mode = None
+        self.stats_lock = threading.Lock()
+        self.events = 0
+        self.reported = 0
+
+    def set_roots(self, roots):
+        roots = sorted(set(r for r in roots if r and os.path.isdir(r)))
+        with self.roots as rs:
+            if rs == roots:
+                return
+            rs[:] = roots
+        self.roots_changed.set()
+
+    def get_roots(self):
+        with self.roots as rs:
+            return rs[:]
+
+    def stop(self):
+        self.stop_event.set()
+        self.roots_changed.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.roots_changed.clear()
+            roots = self.get_roots()
+            try:
+                self.watch_inotify(roots)
+            except OSError as e:
+                log('watcher: inotify unavailable ({0}), polling files'.format(e), log_debug)
+                self.watch_polling(roots)
+
+    def watch_inotify(self, roots):
+        inotify = Inotify()
+        try:
+            for r in roots:
+                for d in walk_dirs(r):
+                    inotify.add_watch(d)
+            self.mode = 'inotify'
+            while not self.roots_changed.is_set():
+                events = inotify.read(1.0)
+                # Drain burst of events (checkout, build) and report it at once
+                while events and len(events) < FileWatcher.max_burst and not self.roots_changed.is_set():
+                    more = inotify.read(0.05)
+                    if not more:
+                        break
+                    events.extend(more)
+                if events:
+                    self.report(*self.classify(inotify, roots, events))
+        finally:
+            inotify.close()
+
+    def classify(self, inotify, roots, events):
+        files = set()
+        paths = []
+        for (path, mask) in events:
+            if path is None:
+                # Queue overflow, changes are lost
+                paths.extend(roots)
+            elif mask & Inotify.IN_ISDIR:
+                if is_excluded_dir(os.path.basename(path)):
+                    continue
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    # Files could be created before watch is added, report all of them
+                    try:
+                        for d in walk_dirs(path):
+                            inotify.add_watch(d)
+                    except OSError as e:
+                        log('watcher: can\'t watch {0}: {1}'.format(path, e), log_debug)
+                    files.update(f for (f, _) in walk_files(path))
+                elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    paths.extend(r for r in roots if path.startswith(r))
+            elif is_watched_file(path):
+                files.add(path)
+        # File can be removed and created again within burst (editors' backups, vcs), its final state matters
+        changed = [f for f in files if os.path.exists(f)]
+        removed = [f for f in files if not os.path.exists(f)]
+        return (changed, removed, paths)
+
+    def watch_polling(self, roots):
+        self.mode = 'polling'
+        mtimes = self.scan(roots)
+        while not self.roots_changed.wait(get_setting_async('watch_poll_interval', 5.0)):
+            new_mtimes = self.scan(roots)
+            changed = [f for (f, t) in new_mtimes.items() if mtimes.get(f) != t]
+            removed = [f for f in mtimes if f not in new_mtimes]
+            mtimes = new_mtimes
+            if changed or removed:
+                self.report(changed, removed, [])
+
+    def scan(self, roots):
+        mtimes = {}
+        for r in roots:
+            mtimes.update(walk_files(r))
+        return mtimes
+
+    def report(self, changed, removed, paths):
+        changed = sorted(set(changed))
+        removed = sorted(set(removed))
+        paths = sorted(set(paths))
+        with self.stats_lock:
+            self.events += 1
+            self.reported += len(changed) + len(removed)
+        if not (changed or removed or paths):
+            return
+        log('watcher: {0} changed, {1} removed, {2} to rescan'.format(len(changed), len(removed), len(paths)), log_trace)
+        try:
+            self.on_changes(changed, removed, paths)
+        except Exception as e:
+            log('watcher: handling changes failed: {0}'.format(e), log_error)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'mode': self.mode,
+                'roots': self.get_roots(),
+                'batches': self.events,
+                'files': self.reported}